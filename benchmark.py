@@ -0,0 +1,326 @@
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+from os import path
+import cv2
+import numpy as np
+from src.common.metrics import Metrics
+from src.common.patch_aggregation import PatchGrid, extract_patches, l2_norm_aggregate, lp_norm_irls_aggregate
+from src.common.patch_aggregation.irls_kernel import NUMBA_AVAILABLE
+from src.common.patch_aggregation.patch_provider import RandomPick, HierarchicalNN, NN, FaissANN, PCAANN, PatchMatch, FFTNN
+from src.style_transfer import StyleTransfer
+from src.texture_synthesis import TextureSynthesis
+
+SEED = 0
+TEXTURE_IMAGE = './test_images/texture_synthesis/input_sample/wara.jpg'
+STYLE_IMAGE = './test_images/style_transfer/style/van_gogh_starry.jpg'
+CONTENT_IMAGE = './test_images/style_transfer/content/city_river.jpg'
+
+# patch settings of test_texture_synthesis.py, one (patch size, patch spacing) per stage
+PATCH_SETTINGS = (((32, 32), (8, 8)), ((16, 16), (4, 4)), ((8, 8), (2, 2)))
+
+PROVIDERS = {
+    'RandomPick': RandomPick,
+    'HierarchicalNN': lambda: HierarchicalNN(n_clusters=4, patch_amount_tol=100),
+    'NN': NN,
+    'FaissANN': FaissANN,
+    'PCAANN': PCAANN,
+    'PatchMatch': PatchMatch,
+    'FFTNN': FFTNN,
+}
+
+AGGREGATORS = {
+    'l2': l2_norm_aggregate,
+    'lp_irls': lambda *args, **kwargs: lp_norm_irls_aggregate(*args, irls_iteration=10, p_norm=1.2, **kwargs),
+}
+if NUMBA_AVAILABLE:
+    AGGREGATORS['lp_irls_numba'] = lambda *args, **kwargs: lp_norm_irls_aggregate(*args, irls_iteration=10, p_norm=1.2, backend='numba', **kwargs)
+
+# modules importing one of these at load time defeat the lazy registry
+HEAVY_MODULES = ('faiss', 'sklearn', 'skimage', 'color_transfer', 'numba')
+
+IMPORT_TARGETS = ('src.style_transfer', 'src.texture_synthesis', 'src.job_server')
+
+
+def seed_all(seed=SEED):
+    """Seed both generators used by the pipelines
+
+    random drives RandomPick (random.choices), np.random drives the noise
+    initialization, the random search of PatchMatch and the clustering.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def load_image(filename, size):
+    image = cv2.imread(filename)
+    if image is None:
+        raise ValueError(f'Can not read {filename}')
+    return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+
+
+def measure(func, repeat):
+    """Run func repeat times, each from the same seed
+
+    Returns:
+        (float, object): Median wall time (seconds) and result of the last run
+    """
+    seconds = []
+    for _ in range(repeat):
+        seed_all()
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return float(np.median(seconds)), result
+
+
+def mean_sq_distance(a, b):
+    return float(np.mean(np.square(np.asarray(a, dtype=np.float64) - np.asarray(b, dtype=np.float64))))
+
+
+def bench_extract_patches(sizes, repeat):
+    records = []
+    for size in sizes:
+        image = load_image(TEXTURE_IMAGE, size)
+        for patch_size, patch_spacing in PATCH_SETTINGS:
+            seconds, patches = measure(lambda: extract_patches(image, patch_size, patch_spacing), repeat)
+            records.append({
+                'bench': 'extract_patches', 'case': f'{patch_size}/{patch_spacing}', 'size': size,
+                'n': len(patches), 'seconds': seconds,
+            })
+            seconds, patch_mat = measure(lambda: PatchGrid(image, patch_size, patch_spacing).to_matrix(), repeat)
+            records.append({
+                'bench': 'patch_matrix', 'case': f'{patch_size}/{patch_spacing}', 'size': size,
+                'n': len(patch_mat), 'seconds': seconds,
+            })
+    return records, {}
+
+
+def bench_providers(sizes, repeat, providers):
+    records, outputs = [], {}
+    for size in sizes:
+        exemplar = load_image(STYLE_IMAGE, size).astype(np.float64)
+        target = load_image(CONTENT_IMAGE, size).astype(np.float64)
+        for patch_size, patch_spacing in PATCH_SETTINGS:
+            exemplar_grid = PatchGrid(exemplar, patch_size, patch_spacing)
+            target_grid = PatchGrid(target, patch_size, patch_spacing)
+            for name in providers:
+                case = f'{name}/{patch_size}/{patch_spacing}'
+
+                def train():
+                    patch_provider = PROVIDERS[name]()
+                    patch_provider.train(exemplar_grid)
+                    return patch_provider
+                seconds, patch_provider = measure(train, repeat)
+                records.append({'bench': 'train', 'case': case, 'size': size, 'n': len(exemplar_grid), 'seconds': seconds})
+
+                def query():
+                    # every run starts from the trained state (PatchMatch keeps its field)
+                    return patch_provider.warm_started(None).get_patches_on_grid(target_grid)
+                seconds, match = measure(query, repeat)
+                energy = mean_sq_distance(match, target_grid.to_matrix())
+                records.append({
+                    'bench': 'query', 'case': case, 'size': size, 'n': len(target_grid), 'seconds': seconds,
+                    'energy': energy,
+                })
+                outputs[f'query/{case}/{size}'] = match
+    return records, outputs
+
+
+def bench_aggregators(sizes, repeat):
+    records, outputs = [], {}
+    for size in sizes:
+        exemplar = load_image(STYLE_IMAGE, size).astype(np.float64)
+        target = load_image(CONTENT_IMAGE, size).astype(np.float64)
+        for patch_size, patch_spacing in PATCH_SETTINGS:
+            patch_provider = NN()
+            patch_provider.train(PatchGrid(exemplar, patch_size, patch_spacing))
+            for name, aggregator in AGGREGATORS.items():
+                case = f'{name}/{patch_size}/{patch_spacing}'
+                stats = {}
+                seconds, output = measure(lambda: aggregator(target, patch_provider, patch_size, patch_spacing, stats=stats), repeat)
+                records.append({
+                    'bench': 'aggregate', 'case': case, 'size': size, 'n': target.shape[0] * target.shape[1],
+                    'seconds': seconds, 'match_seconds': stats['match_seconds'], 'energy': stats['energy'],
+                })
+                outputs[f'aggregate/{case}/{size}'] = output
+    return records, outputs
+
+
+def time_import(statement):
+    """Wall time of statement in a fresh interpreter, and the heavy modules it loaded
+    """
+    code = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        f'{statement}\n'
+        'seconds = time.perf_counter() - start\n'
+        f'print(json.dumps([seconds, [m for m in {HEAVY_MODULES!r} if m in sys.modules]]))\n'
+    )
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=path.dirname(path.abspath(__file__))).stdout
+    seconds, heavy_modules = json.loads(output.splitlines()[-1])
+    return seconds, heavy_modules
+
+
+def bench_imports(repeat, providers):
+    records = []
+    cases = [(target, f'import {target}') for target in IMPORT_TARGETS]
+    # first use of a provider pays for its own dependencies only
+    cases += [(f'src.style_transfer+{name}', f'import src.style_transfer\nfrom src.common.patch_aggregation import provider_class\nprovider_class({name!r})')
+              for name in providers]
+    for case, statement in cases:
+        runs = [time_import(statement) for _ in range(repeat)]
+        records.append({
+            'bench': 'import', 'case': case, 'size': 0, 'n': 1,
+            'seconds': float(np.median([seconds for seconds, _ in runs])), 'heavy_modules': runs[-1][1],
+        })
+    # a plain import loading a heavy module means the lazy registry regressed
+    eager = {record['case']: record['heavy_modules'] for record in records if record['case'] in IMPORT_TARGETS and record['heavy_modules']}
+    if eager:
+        raise SystemExit(f'Heavy modules loaded at import: {eager}')
+    return records, {}
+
+
+def run_pipeline(pipeline, run, repeat):
+    def func():
+        metrics = Metrics()
+        output = run(pipeline.use_metrics(metrics).show_progress(False))
+        return output, metrics.summary(), pipeline.history[-1]['energy']
+    seconds, (output, summary, energy) = measure(func, repeat)
+    stages = {name: entry['total'] for name, entry in summary.items() if entry['kind'] == 'time'}
+    return seconds, output, stages, energy
+
+
+def bench_end_to_end(sizes, repeat):
+    records, outputs = [], {}
+    patch_size_list = [patch_size for patch_size, _ in PATCH_SETTINGS]
+    patch_spacing_list = [patch_spacing for _, patch_spacing in PATCH_SETTINGS]
+    for size in sizes:
+        # the coarsest layer must hold the largest patch
+        if size >> (len(PATCH_SETTINGS)-1) < max(patch_size_list)[0]:
+            print(f'Skip end-to-end runs of size {size}: the coarsest layer is smaller than the patch')
+            continue
+        texture = load_image(TEXTURE_IMAGE, size)
+        synthesis = TextureSynthesis(
+            texture, (2*size, 2*size), 3, patch_size_list, patch_spacing_list, 3,
+        ).search_by_HierarchicalNN(4, 100).aggregate_by_lp_irls(irls_iteration=10, p_norm=1.2)
+        seconds, output, stages, energy = run_pipeline(synthesis, TextureSynthesis.synthesis, repeat)
+        records.append({
+            'bench': 'synthesis', 'case': 'HierarchicalNN/lp_irls', 'size': size, 'n': 4 * size * size,
+            'seconds': seconds, 'stages': stages, 'energy': energy,
+        })
+        outputs[f'synthesis/HierarchicalNN/lp_irls/{size}'] = output
+
+        transfer = StyleTransfer(
+            load_image(CONTENT_IMAGE, size), load_image(STYLE_IMAGE, size), 3,
+            patch_size_list, [tuple(2*s for s in patch_spacing) for patch_spacing in patch_spacing_list], 3,
+        ).search_by_HierarchicalNN(4, 100).aggregate_by_lp_irls(irls_iteration=10, p_norm=1.0)
+        seconds, output, stages, energy = run_pipeline(transfer, StyleTransfer.transfer, repeat)
+        records.append({
+            'bench': 'transfer', 'case': 'HierarchicalNN/lp_irls', 'size': size, 'n': size * size,
+            'seconds': seconds, 'stages': stages, 'energy': energy,
+        })
+        outputs[f'transfer/HierarchicalNN/lp_irls/{size}'] = output
+    return records, outputs
+
+
+def scaling_curves(records):
+    """Fit seconds ~ n**exponent per (bench, case) across image sizes
+
+    Returns:
+        dict: {'bench/case': exponent}
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(f"{record['bench']}/{record['case']}", []).append((record['n'], record['seconds']))
+    curves = {}
+    for key, points in groups.items():
+        n, seconds = np.array(points, dtype=np.float64).T
+        if len(np.unique(n)) > 1 and np.all(seconds > 0):
+            curves[key] = float(np.polyfit(np.log(n), np.log(seconds), 1)[0])
+    return curves
+
+
+def compare(records, outputs, baseline_records, baseline_outputs):
+    """Speedup and output deltas against a baseline run
+
+    Returns:
+        list of dict: One entry per record found in the baseline
+    """
+    baseline = {(r['bench'], r['case'], r['size']): r for r in baseline_records}
+    deltas = []
+    for record in records:
+        key = (record['bench'], record['case'], record['size'])
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        delta = {'bench': record['bench'], 'case': record['case'], 'size': record['size'],
+                 'speedup': base['seconds'] / record['seconds'] if record['seconds'] > 0 else float('inf')}
+        if 'energy' in record and 'energy' in base:
+            delta['energy_change'] = (record['energy'] - base['energy']) / max(base['energy'], 1e-12)
+        output_key = f"{record['bench']}/{record['case']}/{record['size']}"
+        if output_key in outputs and output_key in baseline_outputs:
+            mse = mean_sq_distance(outputs[output_key], baseline_outputs[output_key])
+            delta['psnr'] = float('inf') if mse == 0 else float(10 * np.log10(255**2 / mse))
+        deltas.append(delta)
+    return deltas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark patch extraction, providers, aggregators and pipelines')
+    parser.add_argument('--suites', nargs='+', default=['imports', 'extract', 'providers', 'aggregators', 'end_to_end'],
+                        choices=['imports', 'extract', 'providers', 'aggregators', 'end_to_end'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[64, 128], help='Image sizes (pixels per side)')
+    parser.add_argument('--pipeline-sizes', nargs='+', type=int, default=[128, 256],
+                        help='Input image sizes of the end-to-end runs (the synthesized texture is twice as large)')
+    parser.add_argument('--providers', nargs='+', default=list(PROVIDERS), choices=list(PROVIDERS))
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (the median is reported)')
+    parser.add_argument('--output', default='bench_output', help='Writes <output>.json and <output>.npz')
+    parser.add_argument('--baseline', help='<baseline>.json and <baseline>.npz of a previous run to compare with')
+    args = parser.parse_args()
+
+    suites = {
+        'imports': lambda: bench_imports(args.repeat, args.providers),
+        'extract': lambda: bench_extract_patches(args.sizes, args.repeat),
+        'providers': lambda: bench_providers(args.sizes, args.repeat, args.providers),
+        'aggregators': lambda: bench_aggregators(args.sizes, args.repeat),
+        'end_to_end': lambda: bench_end_to_end(args.pipeline_sizes, args.repeat),
+    }
+    records, outputs = [], {}
+    for suite in args.suites:
+        suite_records, suite_outputs = suites[suite]()
+        records.extend(suite_records)
+        outputs.update(suite_outputs)
+    for record in records:
+        print(f"{record['bench']:16} {record['case']:40} {record['size']:5} n={record['n']:<8} {record['seconds']*1000:10.2f} ms")
+        if record.get('heavy_modules'):
+            print(f"  loaded {', '.join(record['heavy_modules'])}")
+
+    result = {'seed': SEED, 'sizes': args.sizes, 'records': records, 'scaling': scaling_curves(records)}
+    print('Scaling exponents (seconds ~ n**k):')
+    for key, exponent in result['scaling'].items():
+        print(f'  {key:56} k={exponent:.2f}')
+
+    if args.baseline:
+        with open(f'{args.baseline}.json') as f:
+            baseline_records = json.load(f)['records']
+        baseline_outputs = {}
+        if path.exists(f'{args.baseline}.npz'):
+            with np.load(f'{args.baseline}.npz') as data:
+                baseline_outputs = dict(data)
+        result['comparison'] = compare(records, outputs, baseline_records, baseline_outputs)
+        print('Against the baseline:')
+        for delta in result['comparison']:
+            extra = ''.join(f' {key}={delta[key]:.4g}' for key in ('energy_change', 'psnr') if key in delta)
+            print(f"  {delta['bench']:16} {delta['case']:40} {delta['size']:5} speedup={delta['speedup']:.2f}{extra}")
+
+    with open(f'{args.output}.json', 'w') as f:
+        json.dump(result, f, indent=1)
+    np.savez_compressed(f'{args.output}.npz', **outputs)
+
+
+if __name__ == '__main__':
+    main()
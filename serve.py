@@ -0,0 +1,28 @@
+import argparse
+import asyncio
+from src.common.patch_aggregation.patch_provider import ProviderCache
+from src.job_server import JobServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local job server for style transfer and texture synthesis')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket', help='Listen on a Unix socket instead of host and port')
+    parser.add_argument('--workers', type=int, default=1, help='Number of jobs run at the same time')
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--cache-dir', help='Persist trained providers in this directory')
+    parser.add_argument('--cache-entries', type=int, default=16, help='Number of trained providers kept in memory')
+    parser.add_argument('--memory-budget', type=float, help='Planned peak memory allowed per job (MB)')
+    args = parser.parse_args()
+    server = JobServer(
+        n_workers=args.workers,
+        max_queue=args.max_queue,
+        provider_cache=ProviderCache(args.cache_dir, args.cache_entries),
+        memory_budget=None if args.memory_budget is None else int(args.memory_budget * 2**20),
+    )
+    asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+
+
+if __name__ == '__main__':
+    main()
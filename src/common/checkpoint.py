@@ -0,0 +1,138 @@
+import glob
+import hashlib
+import json
+import os
+import random
+import numpy as np
+
+
+class Checkpoint:
+    """Checkpoints of a multi-resolution run, one per (resolution layer, patch setting) stage
+
+    Each stage is saved as a compressed npz holding the output image (in the
+    pipeline dtype), the stage position, the history and the states of
+    random and np.random, so a resumed run draws the same random numbers as
+    an uninterrupted one, and the search state of the patch provider (e.g.
+    the PatchMatch field) warm-starting the next stage. Checkpoints are tagged with a key of the run
+    inputs and settings; checkpoints of other runs are ignored.
+    Saved stages double as progressive low resolution previews.
+
+    Args:
+        directory (str): Directory of the checkpoint files
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(images, settings):
+        """Key of a run
+
+        Args:
+            images (list of ndarray): Inputs of the run
+            settings (tuple): Settings which change the result (repr is hashed)
+
+        Returns:
+            str: Hex digest
+        """
+        digest = hashlib.sha1()
+        for image in images:
+            digest.update(np.ascontiguousarray(image).tobytes())
+            digest.update(repr((image.shape, str(image.dtype))).encode())
+        digest.update(repr(settings).encode())
+        return digest.hexdigest()
+
+    def save(self, key, stage, image, history, provider_state=None):
+        """Save the state after a stage
+
+        Args:
+            key (str): Key of the run
+            stage (int, int): (resolution layer index, patch setting index) just completed
+            image (ndarray): Output image after the stage
+            history (list of dict): History of the run so far
+            provider_state (dict of ndarray, optional): Search state of the patch provider of the stage. Defaults to None.
+        """
+        version, mt_state, gauss_next = random.getstate()
+        np_state = np.random.get_state()
+        path = self._path(stage)
+        # write then rename so that a preempted save never leaves a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(
+                f,
+                key=np.array(key),
+                stage=np.array(stage),
+                image=image,
+                history=np.array(json.dumps(history)),
+                random_state=np.array(mt_state, dtype=np.int64),
+                random_meta=np.array([version, np.nan if gauss_next is None else gauss_next]),
+                np_random_keys=np_state[1],
+                np_random_meta=np.array(np_state[2:], dtype=np.float64),
+                **{f'provider_{name}': value for name, value in (provider_state or {}).items()},
+            )
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        """Load the latest stage of a run and restore the random states
+
+        Args:
+            key (str): Key of the run
+
+        Returns:
+            dict: 'stage', 'image', 'history' and 'provider_state', or None when the run has no checkpoint
+        """
+        for stage in reversed(self.stages()):
+            with np.load(self._path(stage)) as data:
+                if str(data['key']) != key:
+                    continue
+                version, gauss_next = data['random_meta']
+                random.setstate((int(version), tuple(int(v) for v in data['random_state']),
+                                 None if np.isnan(gauss_next) else float(gauss_next)))
+                pos, has_gauss, cached_gaussian = data['np_random_meta']
+                np.random.set_state(('MT19937', data['np_random_keys'], int(pos), int(has_gauss), float(cached_gaussian)))
+                history = json.loads(str(data['history']))
+                for record in history:
+                    record['patch_size'] = tuple(record['patch_size'])
+                return {
+                    'stage': tuple(int(v) for v in data['stage']),
+                    'image': data['image'],
+                    'history': history,
+                    'provider_state': {name[len('provider_'):]: data[name] for name in data.files if name.startswith('provider_')},
+                }
+        return None
+
+    def stages(self):
+        """Saved stages in run order
+
+        Returns:
+            list of (int, int): (resolution layer index, patch setting index)
+        """
+        stages = []
+        for path in glob.glob(os.path.join(self.directory, 'stage_*_*.npz')):
+            _, r_idx, p_idx = os.path.splitext(os.path.basename(path))[0].split('_')
+            stages.append((int(r_idx), int(p_idx)))
+        return sorted(stages)
+
+    def preview(self, stage=None):
+        """Output image of a saved stage
+
+        Args:
+            stage (int, int, optional): Stage. Defaults to the latest one.
+
+        Returns:
+            ndarray: uint8 image at the resolution of the stage
+        """
+        if stage is None:
+            stage = self.stages()[-1]
+        with np.load(self._path(stage)) as data:
+            return np.clip(data['image'], 0, 255).astype(np.uint8)
+
+    def clear(self):
+        """Remove all the saved stages
+        """
+        for stage in self.stages():
+            os.remove(self._path(stage))
+
+    def _path(self, stage):
+        return os.path.join(self.directory, 'stage_{}_{}.npz'.format(*stage))
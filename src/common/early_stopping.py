@@ -0,0 +1,42 @@
+class EarlyStopping:
+    """Convergence check of the outer EM loop
+
+    Call reset() at the beginning of each (resolution layer, patch size)
+    stage and update() after each iteration.
+
+    Args:
+        energy_tol (float, optional): Stop when the relative decrease of the patch matching energy is below this. Defaults to 0 (disabled).
+        change_tol (float, optional): Stop when the RMS image change is below this. Defaults to 0 (disabled).
+        min_iteration (int, optional): Number of iterations always run in a stage. Defaults to 1.
+    """
+
+    def __init__(self, energy_tol=0, change_tol=0, min_iteration=1):
+        self.energy_tol = energy_tol
+        self.change_tol = change_tol
+        self.min_iteration = min_iteration
+        self.reset()
+
+    def reset(self):
+        self._iteration = 0
+        self._pre_energy = None
+
+    def update(self, energy, change):
+        """Record an iteration
+
+        Args:
+            energy (float): Patch matching energy of the iteration
+            change (float): RMS image change of the iteration
+
+        Returns:
+            bool: True when the stage has converged
+        """
+        self._iteration += 1
+        pre_energy = self._pre_energy
+        self._pre_energy = energy
+        if self._iteration < self.min_iteration:
+            return False
+        if self.change_tol and change < self.change_tol:
+            return True
+        if self.energy_tol and pre_energy:
+            return (pre_energy - energy) / pre_energy < self.energy_tol
+        return False
@@ -0,0 +1,86 @@
+import contextlib
+import threading
+import time
+
+
+class Metrics:
+    """Wall times and counts of the pipeline stages
+
+    Each measurement is stored as a record
+    {'name': str, 'kind': 'time' or 'count', 'value': float, **labels}
+    and passed to the callbacks, e.g. to export it to a monitoring system.
+    Records made in forked worker processes only reach the callbacks of
+    the worker.
+
+    Args:
+        callbacks (list of callable, optional): Called with each record
+    """
+
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.records = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Measure the wall time of a block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start, **labels)
+
+    def add_time(self, name, seconds, **labels):
+        self._record(dict(labels, name=name, kind='time', value=seconds))
+
+    def add_count(self, name, value, **labels):
+        self._record(dict(labels, name=name, kind='count', value=value))
+
+    def summary(self):
+        """Totals per name
+
+        Returns:
+            dict: {name: {'kind', 'n' (number of records), 'total'}}
+        """
+        result = {}
+        with self._lock:
+            records = list(self.records)
+        for record in records:
+            entry = result.setdefault(record['name'], {'kind': record['kind'], 'n': 0, 'total': 0})
+            entry['n'] += 1
+            entry['total'] += record['value']
+        return result
+
+    def _record(self, record):
+        with self._lock:
+            self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+
+def record_aggregation(metrics, seconds, stats, labels):
+    """Record one patch aggregation step
+
+    The search time reported by the aggregator is recorded as 'matching'
+    and the rest of the step as 'aggregation'.
+
+    Args:
+        metrics (Metrics): Destination
+        seconds (float): Wall time of the aggregator call
+        stats (dict): Stats filled by the aggregator
+        labels (dict): Labels of the records
+    """
+    metrics.add_time('matching', stats['match_seconds'], **labels)
+    metrics.add_time('aggregation', seconds - stats['match_seconds'], **labels)
+    metrics.add_count('patches_queried', stats['queried'], **labels)
+    if 'irls_iteration' in stats:
+        metrics.add_count('irls_rounds', stats['irls_iteration'], **labels)
+
+
+class NullMetrics(Metrics):
+    """Metrics discarding every record
+    """
+
+    def _record(self, record):
+        pass
@@ -1,2 +1,6 @@
-from .extract_patches import extract_patches
+from .extract_patches import PatchGrid, extract_patches, float_dtype, to_float_patch_matrix, to_patch_matrix
+from .patch_bank import PatchBank, to_float_patch_bank, to_patch_bank
 from .patch_aggregate import l2_norm_aggregate, lp_norm_irls_aggregate
+from .match_cache import MatchCache
+from .adaptive_sampling import AdaptiveSampling
+from .registry import create_provider, get_aggregator, provider_class, register_aggregator, register_provider
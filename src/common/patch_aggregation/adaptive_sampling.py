@@ -0,0 +1,70 @@
+import numpy as np
+
+
+def _patch_means(image, patch_size, patch_spacing, grid_shape):
+    """Mean over each grid patch of a per-pixel map (H, W), by an integral image
+    """
+    p_h, p_w = patch_size
+    s_h, s_w = patch_spacing
+    n_h, n_w = grid_shape
+    integral = np.zeros((image.shape[0]+1, image.shape[1]+1))
+    integral[1:, 1:] = np.cumsum(np.cumsum(image, axis=0), axis=1)
+    top = np.arange(n_h)[:, np.newaxis] * s_h
+    left = np.arange(n_w)[np.newaxis, :] * s_w
+    total = integral[top+p_h, left+p_w] - integral[top, left+p_w] - integral[top+p_h, left] + integral[top, left]
+    return total / (p_h * p_w)
+
+
+def _channel_mean(image):
+    image = np.asarray(image, dtype=np.float64)
+    return image.mean(axis=2) if image.ndim == 3 else image
+
+
+class AdaptiveSampling:
+    """Choose the target patches to be matched by the local detail
+
+    Every patch of the regular grid is matched where the guide image is
+    detailed (standard deviation of the patch above std_threshold, or mean
+    weight above weight_threshold). In flat regions only a coarse sub-grid
+    is matched, whose stride is at most the patch size so that every pixel
+    stays covered. The aggregators skip the other patches.
+
+    Args:
+        std_threshold (float, optional): Standard deviation (pixel value) above which a patch is detailed. Defaults to 8.
+        weight_threshold (float, optional): Mean weight above which a patch is detailed. Defaults to None (weights not used).
+    """
+
+    def __init__(self, std_threshold=8, weight_threshold=None):
+        self.std_threshold = std_threshold
+        self.weight_threshold = weight_threshold
+
+    def mask(self, guide, patch_size, patch_spacing, weight_mat=None):
+        """Patches to be matched
+
+        Args:
+            guide (ndarray): Image the detail is measured on, with the shape of the target image
+            patch_size (int, int): Patch size (height, width)
+            patch_spacing (int, int): Patch sampling gap (height, width)
+            weight_mat (ndarray, optional): Per-pixel weights, e.g. the content weight mat
+
+        Returns:
+            ndarray: Mask (n_h, n_w) of the patches of the grid to be matched
+        """
+        p_h, p_w = patch_size
+        s_h, s_w = patch_spacing
+        n_h = max(0, (guide.shape[0] - p_h) // s_h + 1)
+        n_w = max(0, (guide.shape[1] - p_w) // s_w + 1)
+        guide = np.asarray(guide, dtype=np.float64)
+        mean = _patch_means(_channel_mean(guide), patch_size, patch_spacing, (n_h, n_w))
+        sq_mean = _patch_means(_channel_mean(np.square(guide)), patch_size, patch_spacing, (n_h, n_w))
+        mask = np.sqrt(np.maximum(sq_mean - np.square(mean), 0)) > self.std_threshold
+        if self.weight_threshold is not None and weight_mat is not None:
+            mask |= _patch_means(_channel_mean(weight_mat), patch_size, patch_spacing, (n_h, n_w)) > self.weight_threshold
+
+        # coarse sub-grid keeping every pixel covered
+        k_h, k_w = max(1, p_h // s_h), max(1, p_w // s_w)
+        mask[::k_h, ::k_w] = True
+        mask[-1:, ::k_w] = True
+        mask[::k_h, -1:] = True
+        mask[-1:, -1:] = True
+        return mask
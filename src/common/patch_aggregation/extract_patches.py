@@ -1,3 +1,74 @@
+import numpy as np
+
+
+class PatchGrid:
+    """Patches sampled on a regular grid
+
+    The patches are a strided view of the input_img (no copy).
+    Indexing and iteration follow the order of extract_patches (row-major).
+
+    Args:
+        input_img (ndarray): image
+        patch_size (int, int): patch size (height, width)
+        patch_spacing (int, int): patch sampling gap (height, width)
+    """
+
+    def __init__(self, input_img, patch_size, patch_spacing):
+        p_h, p_w = patch_size
+        s_h, s_w = patch_spacing
+        max_h, max_w = input_img.shape[:2]
+        n_h = max(0, (max_h - p_h) // s_h + 1)
+        n_w = max(0, (max_w - p_w) // s_w + 1)
+        st_h, st_w = input_img.strides[:2]
+        self.image = input_img
+        self.patch_size = (p_h, p_w)
+        self.patch_spacing = (s_h, s_w)
+        self.patch_shape = (p_h, p_w) + input_img.shape[2:]
+        self.grid_shape = (n_h, n_w)
+        # (n_h, n_w, p_h, p_w, C)
+        self.patches = np.lib.stride_tricks.as_strided(
+            input_img,
+            shape=self.grid_shape + self.patch_shape,
+            strides=(st_h*s_h, st_w*s_w) + input_img.strides)
+
+    @property
+    def coords(self):
+        """Top-left coordinates (N, 2) of the patches as (h, w)
+        """
+        idx_h, idx_w = np.meshgrid(
+            np.arange(self.grid_shape[0]) * self.patch_spacing[0],
+            np.arange(self.grid_shape[1]) * self.patch_spacing[1],
+            indexing='ij')
+        return np.stack([idx_h.ravel(), idx_w.ravel()], axis=1)
+
+    def to_matrix(self, dtype=None):
+        """Patches as a (N, D) matrix, one raveled patch per row
+
+        Args:
+            dtype (dtype, optional): dtype of the matrix. Defaults to the image dtype.
+
+        Returns:
+            ndarray: Patch matrix
+        """
+        mat = self.patches.reshape(len(self), int(np.prod(self.patch_shape)))
+        if dtype is not None:
+            mat = mat.astype(dtype, copy=False)
+        return mat
+
+    def to_list(self):
+        return [self.patches[i, j] for i in range(self.grid_shape[0]) for j in range(self.grid_shape[1])]
+
+    def __len__(self):
+        return self.grid_shape[0] * self.grid_shape[1]
+
+    def __getitem__(self, idx):
+        idx = range(len(self))[idx]
+        return self.patches[divmod(idx, self.grid_shape[1])]
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+
 def extract_patches(input_img, patch_size, patch_spacing):
     """Patch extraction
 
@@ -11,17 +82,39 @@ def extract_patches(input_img, patch_size, patch_spacing):
     Returns:
         list of ndarray: list of patches.
     """
-    patches = []
-    p_h, p_w = patch_size
-    s_h, s_w = patch_spacing
-    max_h, max_w = input_img.shape[:2]
-    idx_h, idx_w = (0, 0)
-    while 1:
-        if idx_h + p_h > max_h or idx_w + p_w > max_w:
-            break
-        patches.append(input_img[idx_h:idx_h+p_h, idx_w:idx_w+p_w])
-        idx_w += s_w
-        if idx_w+p_w > max_w:
-            idx_w = 0
-            idx_h += s_h
-    return patches
+    return PatchGrid(input_img, patch_size, patch_spacing).to_list()
+
+
+def to_patch_matrix(patches):
+    """Convert patches to a (N, D) matrix
+
+    Args:
+        patches (PatchGrid or list of ndarray): Patches
+
+    Returns:
+        ndarray: Patch matrix, one raveled patch per row
+    """
+    if isinstance(patches, PatchGrid):
+        return patches.to_matrix()
+    return np.array([p.ravel() for p in patches])
+
+
+def float_dtype(dtype):
+    """Floating point dtype to compute in (float64 for integer images)
+    """
+    return dtype if np.issubdtype(dtype, np.floating) else np.dtype(np.float64)
+
+
+def to_float_patch_matrix(patches):
+    """Convert patches to a floating point (N, D) matrix
+
+    Floating point patches keep their precision, integer patches become float64.
+
+    Args:
+        patches (PatchGrid or list of ndarray): Patches
+
+    Returns:
+        ndarray: Patch matrix, one raveled patch per row
+    """
+    mat = to_patch_matrix(patches)
+    return mat.astype(float_dtype(mat.dtype), copy=False)
@@ -0,0 +1,107 @@
+import importlib.util
+import numpy as np
+
+# numba is imported and the kernel compiled on first use
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+
+# numba.prange once the kernel is compiled
+prange = range
+_compiled_irls_rounds = None
+
+
+def _irls_rounds(image, match, mask, s_h, s_w, irls_iteration, p_norm, irls_tol, noise):
+    """IRLS rounds, each fused into a pass over the patches and a pass over the pixels
+
+    The patch pass computes the distance of every patch to its match, the
+    pixel pass gathers the weighted matches covering each pixel and
+    normalizes them, so no intermediate image is materialized and the
+    rows are processed in parallel without write conflicts.
+
+    Args:
+        image (ndarray): Image (H, W, C), updated in place
+        match (ndarray): Matched patches (n_h, n_w, p_h, p_w, C)
+        mask (ndarray): Weights (n_h, n_w) of the patches, 0 for the skipped ones
+        s_h (int): Patch sampling gap (height)
+        s_w (int): Patch sampling gap (width)
+        irls_iteration (int): Number of IRLS rounds
+        p_norm (float): P-norm
+        irls_tol (float): Convergence condition (rate of change of the distance sum)
+        noise (float): Added to avoid zero division
+
+    Returns:
+        int: Number of rounds run
+    """
+    n_h, n_w, p_h, p_w, n_c = match.shape
+    height, width = image.shape[0], image.shape[1]
+    weights = np.empty((n_h, n_w))
+    pre_distance_sum = 0.0
+    rounds = 0
+    for itr in range(irls_iteration):
+        for i in prange(n_h):
+            for j in range(n_w):
+                acc = 0.0
+                for y in range(p_h):
+                    for x in range(p_w):
+                        for c in range(n_c):
+                            d = match[i, j, y, x, c] - image[i*s_h+y, j*s_w+x, c]
+                            acc += d * d
+                weights[i, j] = np.sqrt(acc) + noise
+        distance_sum = (weights * mask).sum()
+        if irls_tol != 0 and itr != 0 and np.abs(distance_sum-pre_distance_sum)/pre_distance_sum < irls_tol:
+            break
+        pre_distance_sum = distance_sum
+        for i in prange(n_h):
+            for j in range(n_w):
+                weights[i, j] = mask[i, j] * weights[i, j] ** (p_norm-2)
+        for py in prange(height):
+            # grid rows i with i*s_h <= py < i*s_h+p_h
+            i_start = max(0, (py - p_h) // s_h + 1)
+            i_end = min(n_h, py // s_h + 1)
+            for px in range(width):
+                j_start = max(0, (px - p_w) // s_w + 1)
+                j_end = min(n_w, px // s_w + 1)
+                for c in range(n_c):
+                    value = 0.0
+                    weight = 0.0
+                    for i in range(i_start, i_end):
+                        for j in range(j_start, j_end):
+                            value += weights[i, j] * match[i, j, py-i*s_h, px-j*s_w, c]
+                            weight += weights[i, j]
+                    image[py, px, c] = value / (weight + noise)
+        rounds += 1
+    return rounds
+
+
+def _get_kernel():
+    global prange, _compiled_irls_rounds
+    if _compiled_irls_rounds is None:
+        import numba
+        prange = numba.prange
+        _compiled_irls_rounds = numba.njit(parallel=True, cache=True, error_model='numpy')(_irls_rounds)
+    return _compiled_irls_rounds
+
+
+def irls_rounds(image, match, patch_spacing, irls_iteration, p_norm, irls_tol, noise, mask=None):
+    """Run the IRLS rounds of lp_norm_irls_aggregate with the Numba kernel
+
+    Args:
+        image (ndarray): Image (H, W) or (H, W, C), updated in place
+        match (ndarray): Matched patches (n_h, n_w, p_h, p_w) or (n_h, n_w, p_h, p_w, C)
+        patch_spacing (int, int): Patch sampling gap (height, width)
+        irls_iteration (int): Number of IRLS rounds
+        p_norm (float): P-norm
+        irls_tol (float): Convergence condition (rate of change of the distance sum)
+        noise (float): Added to avoid zero division
+        mask (ndarray, optional): Patches (n_h, n_w) to be aggregated. Defaults to all.
+
+    Returns:
+        int: Number of rounds run
+    """
+    if not NUMBA_AVAILABLE:
+        raise ImportError('The numba backend requires numba')
+    h, w = image.shape[:2]
+    n_h, n_w, p_h, p_w = match.shape[:4]
+    mask = np.ones((n_h, n_w)) if mask is None else np.asarray(mask, dtype=np.float64)
+    return _get_kernel()(
+        image.reshape(h, w, -1), np.ascontiguousarray(match).reshape(n_h, n_w, p_h, p_w, -1), mask,
+        patch_spacing[0], patch_spacing[1], irls_iteration, float(p_norm), float(irls_tol), noise)
@@ -0,0 +1,82 @@
+import numpy as np
+from .extract_patches import float_dtype
+
+
+class MatchCache:
+    """Reuse the matches of target patches which barely changed
+
+    Keeps the query and the match of each target patch, and re-queries
+    only the patches whose RMS change since their last query exceeds the
+    threshold. The cache is reset when the provider or the grid changes.
+    Providers relying on the layout of the queries (PatchMatch) are always
+    queried with the whole grid.
+
+    Args:
+        threshold (float): RMS change (pixel value) of a patch above which it is re-queried
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.queried = 0
+        self.skipped = 0
+        self._patch_provider = None
+        self._grid_key = None
+        self._query = None
+        self._match = None
+        self._valid = None
+
+    def get_patches_on_grid(self, patch_provider, patch_grid, mask=None):
+        """Batched query through the cache
+
+        Args:
+            patch_provider (PatchProvider): Patch provider
+            patch_grid (PatchGrid): Patches to be queried
+            mask (ndarray, optional): Patches (n_h, n_w) to be queried, the matches of the others are undefined
+
+        Returns:
+            ndarray: Matched patches (N, D), one raveled patch per row
+        """
+        grid_key = (patch_grid.grid_shape, patch_grid.patch_shape, patch_grid.patch_spacing)
+        if patch_provider.uses_grid_layout or patch_provider is not self._patch_provider or grid_key != self._grid_key:
+            self._patch_provider = patch_provider
+            self._grid_key = grid_key
+            self._query = patch_grid.to_matrix(float_dtype(patch_grid.image.dtype))
+            if mask is None or patch_provider.uses_grid_layout:
+                self._match = patch_provider.get_patches_on_grid(patch_grid)
+                self._valid = np.ones(len(self._query), dtype=bool)
+            else:
+                self._valid = mask.ravel().copy()
+                selected_match = patch_provider.get_patches(self._query[self._valid])
+                self._match = np.zeros((len(self._query), selected_match.shape[1]), dtype=selected_match.dtype)
+                self._match[self._valid] = selected_match
+            n_queried = int(np.count_nonzero(self._valid))
+            self.queried += n_queried
+            self.skipped += len(self._query) - n_queried
+            return self._match
+
+        query = patch_grid.to_matrix(float_dtype(patch_grid.image.dtype))
+        residual = query - self._query
+        change = np.sqrt(np.einsum('ij,ij->i', residual, residual) / query.shape[1])
+        # patches never queried are stale however little they changed
+        stale = (change > self.threshold) | ~self._valid
+        if mask is not None:
+            stale &= mask.ravel()
+        if stale.any():
+            self._match[stale] = patch_provider.get_patches(query[stale])
+            self._query[stale] = query[stale]
+            self._valid[stale] = True
+        n_stale = int(np.count_nonzero(stale))
+        self.queried += n_stale
+        self.skipped += len(query) - n_stale
+        return self._match
+
+    def stats(self):
+        """Counters of queried and skipped patches
+
+        Returns:
+            dict: queried, skipped
+        """
+        return {
+            'queried': self.queried,
+            'skipped': self.skipped,
+        }
@@ -1,12 +1,102 @@
+import time
+import warnings
 import numpy as np
 
-from .extract_patches import extract_patches
+from .extract_patches import PatchGrid, float_dtype
+from . import irls_kernel
 
 # avoid zero division
 NOISE = 0.000001
 
 
-def l2_norm_aggregate(initial_output_image, patch_provider, patch_size, patch_spacing):
+def _get_match_patches(patch_provider, patch_grid, match_cache=None, stats=None, mask=None):
+    """Query all patches at once
+
+    Args:
+        patch_provider (PatchProvider): Patch provider
+        patch_grid (PatchGrid): Patches to be queried
+        match_cache (MatchCache, optional): Cache of the previous matches
+        stats (dict, optional): Filled with 'queried' (number of patches queried) and 'match_seconds' (wall time of the search)
+        mask (ndarray, optional): Patches (n_h, n_w) to be queried, the matches of the others are undefined
+
+    Returns:
+        ndarray: Matched patches (n_h, n_w, p_h, p_w, C)
+    """
+    start = time.perf_counter()
+    if match_cache is not None:
+        pre_queried = match_cache.queried
+        match = match_cache.get_patches_on_grid(patch_provider, patch_grid, mask)
+        queried = match_cache.queried - pre_queried
+    elif mask is None or patch_provider.uses_grid_layout:
+        # a field on the grid (PatchMatch, also wrapped by ParallelPatchProvider) needs every patch
+        match = patch_provider.get_patches_on_grid(patch_grid)
+        queried = len(patch_grid)
+    else:
+        selected = mask.ravel()
+        selected_match = patch_provider.get_patches(patch_grid.to_matrix()[selected])
+        match = np.zeros((len(patch_grid), selected_match.shape[1]), dtype=selected_match.dtype)
+        match[selected] = selected_match
+        queried = len(selected_match)
+    if stats is not None:
+        stats['queried'] = queried
+        stats['match_seconds'] = time.perf_counter() - start
+    return match.reshape(patch_grid.grid_shape + patch_grid.patch_shape)
+
+
+def _scatter_add(image, patches, patch_spacing):
+    """Accumulate overlapping patches into the image (col2im)
+
+    One strided add is issued per offset inside the patch, so the cost does
+    not depend on the number of patches in Python.
+
+    Args:
+        image (ndarray): Image to be accumulated into
+        patches (ndarray): Patches (n_h, n_w, p_h, p_w, C) laid out on the grid
+        patch_spacing (int, int): Patch sampling gap(width, height)
+    """
+    n_h, n_w, p_h, p_w = patches.shape[:4]
+    if n_h == 0 or n_w == 0:
+        return
+    s_h, s_w = patch_spacing
+    for dy in range(p_h):
+        for dx in range(p_w):
+            image[dy:dy+s_h*(n_h-1)+1:s_h, dx:dx+s_w*(n_w-1)+1:s_w] += patches[:, :, dy, dx]
+
+
+def _patch_distances(match_patches, patches):
+    """L2 distance of each pair of patches
+
+    Args:
+        match_patches (ndarray): Patches (n_h, n_w, p_h, p_w, C)
+        patches (ndarray): Patches (n_h, n_w, p_h, p_w, C)
+
+    Returns:
+        ndarray: Distances (n_h, n_w)
+    """
+    n_h, n_w = patches.shape[:2]
+    residual = (match_patches - patches).reshape(n_h, n_w, -1)
+    return np.sqrt(np.einsum('ijk,ijk->ij', residual, residual))
+
+
+def _mask_weights(mask, match_patches, dtype):
+    """Per-patch 0/1 weights broadcastable over the patches, None without mask
+    """
+    if mask is None:
+        return None
+    return mask.astype(dtype).reshape(mask.shape + (1,) * (match_patches.ndim - 2))
+
+
+def _masked_mean(values, mask):
+    return float(np.mean(values if mask is None else values[mask]))
+
+
+def _image_change(new_image, old_image):
+    """RMS difference between two images
+    """
+    return float(np.sqrt(np.mean(np.square(new_image - old_image))))
+
+
+def l2_norm_aggregate(initial_output_image, patch_provider, patch_size, patch_spacing, stats=None, match_cache=None, mask=None):
     """Aggregate by L2 norm optimization
 
     Args:
@@ -14,25 +104,38 @@ def l2_norm_aggregate(initial_output_image, patch_provider, patch_size, patch_sp
         patch_provider (PatchProvider): Patch provider
         patch_size (int, int): Patch size(width, height)
         patch_spacing (int, int): Patch sampling gap(width, height)
+        stats (dict, optional): Filled with 'energy' (mean squared distance between the matched patches and the patches
+            of the returned image), 'change' (RMS image change), 'queried' (number of patches queried)
+            and 'match_seconds' (wall time of the search)
+        match_cache (MatchCache, optional): Re-query only the patches changed since the previous call
+        mask (ndarray, optional): Patches (n_h, n_w) to be matched and aggregated, e.g. from AdaptiveSampling. Defaults to all.
 
     Returns:
-        ndarray: Aggregated result
+        ndarray: Aggregated result (in the floating point dtype of initial_output_image, float64 for integer images)
     """
-    new_output_image = np.zeros(initial_output_image.shape, dtype=np.float64)
-    addition_count_mat = np.zeros(initial_output_image.shape, dtype=np.float64)
-    new_output_patches = extract_patches(new_output_image, patch_size, patch_spacing)
-    addition_count_patches = extract_patches(addition_count_mat, patch_size, patch_spacing)
-    initial_output_patches = extract_patches(initial_output_image, patch_size, patch_spacing)
-
-    for i in range(len(new_output_patches)):
-        new_output_patches[i][:] += patch_provider.get_patch(initial_output_patches[i])
-        addition_count_patches[i][:] += 1
+    dtype = float_dtype(initial_output_image.dtype)
+    new_output_image = np.zeros(initial_output_image.shape, dtype=dtype)
+    addition_count_mat = np.zeros(initial_output_image.shape, dtype=dtype)
+    initial_output_patches = PatchGrid(initial_output_image, patch_size, patch_spacing)
+
+    match_result_patches = _get_match_patches(patch_provider, initial_output_patches, match_cache, stats, mask)
+    patch_weights = _mask_weights(mask, match_result_patches, dtype)
+    if patch_weights is None:
+        _scatter_add(new_output_image, match_result_patches, patch_spacing)
+        _scatter_add(addition_count_mat, np.broadcast_to(1.0, match_result_patches.shape), patch_spacing)
+    else:
+        _scatter_add(new_output_image, match_result_patches*patch_weights, patch_spacing)
+        _scatter_add(addition_count_mat, np.broadcast_to(patch_weights, match_result_patches.shape), patch_spacing)
     addition_count_mat[addition_count_mat == 0] = 1
     new_output_image[:] /= addition_count_mat
+    if stats is not None:
+        distance = _patch_distances(match_result_patches, PatchGrid(new_output_image, patch_size, patch_spacing).patches)
+        stats['energy'] = _masked_mean(np.square(distance), mask)
+        stats['change'] = _image_change(new_output_image, initial_output_image)
     return new_output_image
 
 
-def lp_norm_irls_aggregate(initial_output_image, patch_provider, patch_size, patch_spacing, irls_iteration=10, p_norm=1.2, irls_tol=0):
+def lp_norm_irls_aggregate(initial_output_image, patch_provider, patch_size, patch_spacing, irls_iteration=10, p_norm=1.2, irls_tol=0, stats=None, match_cache=None, backend='numpy', mask=None):
     """Aggregate by IRLS robust optimization (LP norm linear regression)
 
     Args:
@@ -43,38 +146,58 @@ def lp_norm_irls_aggregate(initial_output_image, patch_provider, patch_size, pat
         irls_iteration (int, optional): Number of iteration for IRLS
         p_norm (float, optional): P-norm for IRLS
         irls_tol (float, optional): Convergence condition for IRLS (Rate of change of mean deviation)
+        stats (dict, optional): Filled with 'energy' (mean p-th power distance between the matched patches and the patches
+            of the returned image), 'change' (RMS image change), 'irls_iteration' (IRLS rounds run),
+            'queried' (number of patches queried) and 'match_seconds' (wall time of the search)
+        match_cache (MatchCache, optional): Re-query only the patches changed since the previous call
+        backend (str, optional): 'numpy' or 'numba' (fused parallel kernel, falls back to 'numpy' without numba). Defaults to 'numpy'.
+        mask (ndarray, optional): Patches (n_h, n_w) to be matched and aggregated, e.g. from AdaptiveSampling. Defaults to all.
 
     Returns:
-        ndarray: Aggregated result
+        ndarray: Aggregated result (in the floating point dtype of initial_output_image, float64 for integer images)
     """
-    aggregate_result_image = initial_output_image.copy().astype(np.float64)
-
-    aggregate_result_patches = extract_patches(aggregate_result_image, patch_size, patch_spacing)
-
-    weight_mat = np.zeros(initial_output_image.shape, dtype=np.float64)
-    weight_patches = extract_patches(weight_mat, patch_size, patch_spacing)
-    initial_output_patches = extract_patches(initial_output_image, patch_size, patch_spacing)
-
-    match_result_patches = []
-    for p in initial_output_patches:
-        match_result_patches.append(patch_provider.get_patch(p))
-    pre_distance_sum = 0
-    for itr in range(irls_iteration):
-        weight_mat[:] = 0
-        weights = []
-        distance_sum = 0
-        for i in range(len(aggregate_result_patches)):
-            distance = np.linalg.norm(match_result_patches[i] - aggregate_result_patches[i])
-            distance += NOISE
-            weights.append(np.power(distance, p_norm-2))
-            distance_sum += distance
-        # check convergence condition
-        if irls_tol and itr != 0 and np.abs(distance_sum-pre_distance_sum)/pre_distance_sum < irls_tol:
-            break
-        pre_distance_sum = distance_sum
-        aggregate_result_image[:] = 0
-        for i in range(len(aggregate_result_patches)):
-            weight_patches[i][:] += weights[i]
-            aggregate_result_patches[i][:] += match_result_patches[i]*weights[i]
-        aggregate_result_image[:] /= (weight_mat+NOISE)
+    if backend not in ('numpy', 'numba'):
+        raise ValueError(f'Unknown backend: {backend}')
+    if backend == 'numba' and not irls_kernel.NUMBA_AVAILABLE:
+        warnings.warn('numba is not installed, falling back to the numpy backend')
+        backend = 'numpy'
+    dtype = float_dtype(initial_output_image.dtype)
+    aggregate_result_image = initial_output_image.astype(dtype)
+
+    aggregate_result_patches = PatchGrid(aggregate_result_image, patch_size, patch_spacing)
+    initial_output_patches = PatchGrid(initial_output_image, patch_size, patch_spacing)
+
+    match_result_patches = _get_match_patches(patch_provider, initial_output_patches, match_cache, stats, mask)
+    patch_weights = _mask_weights(mask, match_result_patches, dtype)
+    if backend == 'numba':
+        irls_rounds = irls_kernel.irls_rounds(aggregate_result_image, match_result_patches, patch_spacing, irls_iteration, p_norm, irls_tol, NOISE, mask)
+    else:
+        weight_mat = np.zeros(initial_output_image.shape, dtype=dtype)
+        # broadcast per-patch scalars over (p_h, p_w, C)
+        weight_shape = aggregate_result_patches.grid_shape + (1,) * len(aggregate_result_patches.patch_shape)
+        pre_distance_sum = 0
+        irls_rounds = 0
+        for itr in range(irls_iteration):
+            weight_mat[:] = 0
+            distance = _patch_distances(match_result_patches, aggregate_result_patches.patches) + NOISE
+            weights = np.power(distance, p_norm-2).reshape(weight_shape)
+            if patch_weights is not None:
+                # skipped patches neither vote nor count in the convergence check
+                weights = weights * patch_weights
+                distance = distance[mask]
+            distance_sum = distance.sum()
+            # check convergence condition
+            if irls_tol and itr != 0 and np.abs(distance_sum-pre_distance_sum)/pre_distance_sum < irls_tol:
+                break
+            pre_distance_sum = distance_sum
+            aggregate_result_image[:] = 0
+            _scatter_add(weight_mat, np.broadcast_to(weights, match_result_patches.shape), patch_spacing)
+            _scatter_add(aggregate_result_image, match_result_patches*weights, patch_spacing)
+            aggregate_result_image[:] /= (weight_mat+NOISE)
+            irls_rounds += 1
+    if stats is not None:
+        distance = _patch_distances(match_result_patches, aggregate_result_patches.patches)
+        stats['energy'] = _masked_mean(np.power(distance, p_norm), mask)
+        stats['change'] = _image_change(aggregate_result_image, initial_output_image)
+        stats['irls_iteration'] = irls_rounds
     return aggregate_result_image
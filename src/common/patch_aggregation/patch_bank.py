@@ -0,0 +1,165 @@
+import os
+import tempfile
+import numpy as np
+from .extract_patches import PatchGrid, float_dtype, to_patch_matrix
+
+
+class PatchBank:
+    """Exemplar patches stored once as a contiguous (N, D) matrix
+
+    Providers keep the bank, search on its matrix and return its rows, so
+    the exemplar patches exist once in memory. The matrix can be a
+    memory-mapped .npy file, so exemplars with millions of patches are
+    paged from disk instead of being held in memory.
+
+    Args:
+        matrix (ndarray): Patch matrix (N, D), one raveled patch per row
+        patch_shape (tuple): Shape of a patch
+        grid_shape (int, int, optional): Grid the patches were sampled on (row-major)
+        patch_spacing (int, int, optional): Patch sampling gap of the grid
+    """
+
+    def __init__(self, matrix, patch_shape, grid_shape=None, patch_spacing=None):
+        self.matrix = matrix
+        self.patch_shape = tuple(patch_shape)
+        self.grid_shape = None if grid_shape is None else tuple(grid_shape)
+        self.patch_spacing = None if patch_spacing is None else tuple(patch_spacing)
+        self._sq_norm = None
+
+    @classmethod
+    def from_patches(cls, patches, dtype=None, path=None):
+        """Build a bank
+
+        Args:
+            patches (PatchGrid, PatchBank or list of ndarray): Patches
+            dtype (dtype, optional): dtype of the matrix. Defaults to the dtype of the patches.
+            path (str, optional): .npy file the matrix is written to and memory-mapped from.
+                The file is replaced atomically, banks still mapping a previous file keep their patches.
+
+        Returns:
+            PatchBank: Bank (patches itself when it is a bank of the dtype and no path is given)
+        """
+        if isinstance(patches, PatchBank):
+            if path is None and (dtype is None or patches.dtype == dtype):
+                return patches
+            grid_shape, patch_spacing = patches.grid_shape, patches.patch_spacing
+        elif isinstance(patches, PatchGrid):
+            grid_shape, patch_spacing = patches.grid_shape, patches.patch_spacing
+        else:
+            grid_shape, patch_spacing = None, None
+        patch_shape = _patch_shape(patches)
+        if path is None:
+            matrix = _patch_matrix(patches)
+            if dtype is not None:
+                matrix = matrix.astype(dtype, copy=False)
+            return cls(matrix, patch_shape, grid_shape, patch_spacing)
+
+        dtype = np.dtype(dtype if dtype is not None else _patch_dtype(patches))
+        fd, temp_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            matrix = np.lib.format.open_memmap(temp_path, mode='w+', dtype=dtype, shape=(len(patches), int(np.prod(patch_shape))))
+            if isinstance(patches, PatchGrid):
+                # one grid row at a time, the patches are never all in memory
+                n_w = patches.grid_shape[1]
+                for i in range(patches.grid_shape[0]):
+                    matrix[i*n_w:(i+1)*n_w] = patches.patches[i].reshape(n_w, -1)
+            else:
+                matrix[:] = _patch_matrix(patches)
+            matrix.flush()
+            del matrix
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return cls(np.load(path, mmap_mode='r'), patch_shape, grid_shape, patch_spacing)
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    @property
+    def sq_norm(self):
+        """Squared norms (N,) of the patches
+        """
+        if self._sq_norm is None:
+            self._sq_norm = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        return self._sq_norm
+
+    @property
+    def coords(self):
+        """Top-left coordinates (N, 2) of the patches as (h, w), None when the patches are not on a grid
+        """
+        if self.grid_shape is None:
+            return None
+        idx_h, idx_w = np.meshgrid(
+            np.arange(self.grid_shape[0]) * self.patch_spacing[0],
+            np.arange(self.grid_shape[1]) * self.patch_spacing[1],
+            indexing='ij')
+        return np.stack([idx_h.ravel(), idx_w.ravel()], axis=1)
+
+    def patch(self, idx):
+        return self.matrix[idx].reshape(self.patch_shape)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def get_state(self):
+        state = {
+            'patch_mat': self.matrix,
+            'patch_shape': np.array(self.patch_shape),
+        }
+        if self.grid_shape is not None:
+            state['grid_shape'] = np.array(self.grid_shape)
+            state['patch_spacing'] = np.array(self.patch_spacing)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['patch_mat'], state['patch_shape'], state.get('grid_shape'), state.get('patch_spacing'))
+
+
+def _patch_matrix(patches):
+    if isinstance(patches, PatchBank):
+        return patches.matrix
+    return to_patch_matrix(patches)
+
+
+def _patch_shape(patches):
+    if isinstance(patches, (PatchBank, PatchGrid)):
+        return patches.patch_shape
+    return np.shape(patches[0])
+
+
+def _patch_dtype(patches):
+    if isinstance(patches, PatchBank):
+        return patches.dtype
+    if isinstance(patches, PatchGrid):
+        return patches.image.dtype
+    return np.asarray(patches[0]).dtype
+
+
+def to_patch_bank(patches):
+    """Bank of the patches in their dtype
+
+    Args:
+        patches (PatchGrid, PatchBank or list of ndarray): Patches
+
+    Returns:
+        PatchBank: Bank
+    """
+    return PatchBank.from_patches(patches)
+
+
+def to_float_patch_bank(patches):
+    """Bank of the patches in floating point
+
+    Floating point patches keep their precision, integer patches become float64.
+
+    Args:
+        patches (PatchGrid, PatchBank or list of ndarray): Patches
+
+    Returns:
+        PatchBank: Bank
+    """
+    return PatchBank.from_patches(patches, float_dtype(np.dtype(_patch_dtype(patches))))
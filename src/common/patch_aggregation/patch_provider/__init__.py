@@ -1,4 +1,10 @@
-from .random_pick import RandomPick
-from .hierarchical_nn import HierarchicalNN
-from .nn import NN
-from .faiss_ann import FaissANN
+from .provider_cache import ProviderCache
+from .parallel import ParallelPatchProvider
+from ..registry import PROVIDERS, provider_class
+
+
+def __getattr__(name):
+    # providers are imported on first access, with their dependencies
+    if name in PROVIDERS:
+        return provider_class(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
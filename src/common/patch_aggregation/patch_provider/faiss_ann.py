@@ -1,22 +1,45 @@
 from .patch_provider import PatchProvider
 import faiss
 import numpy as np
+from ..patch_bank import PatchBank, to_patch_bank
 
 
 class FaissANN(PatchProvider):
     """Approximate nearest neighbor search using FAISS
     """
 
-    def get_patch(self, ref_patch):
-        return super().get_patch(ref_patch)
-
     def train(self, patches):
-        self._patches = patches
-        data = np.array([p.astype(np.float32).ravel() for p in patches])
+        self._bank = to_patch_bank(patches)
+        self._patch_mat = self._bank.matrix
+        data = np.ascontiguousarray(self._patch_mat, dtype=np.float32)
         self._index = faiss.IndexFlatL2(data.shape[1])
         self._index.add(data)
 
     def get_patch(self, ref_patch):
         distance, indices = self._index.search(
             np.array([ref_patch.astype(np.float32).ravel()]), k=1)
-        return self._patches[indices[0][0]]
+        return self._bank.patch(indices[0][0])
+
+    def get_indices(self, ref_patches):
+        """Search the nearest patch index of each query
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D)
+
+        Returns:
+            ndarray: Indices (N,) of the matched patches
+        """
+        distance, indices = self._index.search(
+            np.ascontiguousarray(ref_patches, dtype=np.float32), k=1)
+        return indices[:, 0]
+
+    def get_patches(self, ref_patches):
+        return self._patch_mat[self.get_indices(ref_patches)]
+
+    def get_state(self):
+        return dict(self._bank.get_state(), index=faiss.serialize_index(self._index))
+
+    def set_state(self, state):
+        self._bank = PatchBank.from_state(state)
+        self._patch_mat = self._bank.matrix
+        self._index = faiss.deserialize_index(state['index'])
@@ -0,0 +1,142 @@
+import numpy as np
+from .patch_provider import PatchProvider
+from ..patch_bank import PatchBank, to_float_patch_bank
+
+# upper bound of the spectrum elements computed at once
+CHUNK_ELEMENTS = 2**20
+
+
+class FFTNN(PatchProvider):
+    """Exact nearest neighbor search by FFT cross-correlation
+
+    The squared distance between a query and the exemplar patch at (y, x)
+    is ||q||^2 - 2 corr(y, x) + ||e(y, x)||^2. The patch energies come from
+    an integral image. The correlations with every patch of the exemplar
+    grid are computed in the frequency domain: the exemplar is split into
+    its spacing phases (one sub-image per offset inside the spacing and
+    channel) whose spectra are precomputed. As a query covers only a few
+    taps of each phase, its spectrum, the products with the exemplar
+    spectra summed over the phases and the inverse transform at the grid
+    positions are all matrix products. The cost per query grows with the
+    exemplar size and the patch height over the spacing, not with the
+    patch dimensionality times the number of patches as a brute force
+    search does. The search covers every patch of the trained grid;
+    train with spacing (1, 1) for the full dense grid.
+    """
+
+    def train(self, input_patches):
+        if getattr(input_patches, 'grid_shape', None) is None:
+            raise ValueError('FFTNN requires the patches as a PatchGrid or a PatchBank sampled on a grid')
+        bank = to_float_patch_bank(input_patches)
+        self._set_bank(bank, getattr(input_patches, 'image', None))
+
+    def get_patch(self, ref_patch):
+        return self._bank.patch(self.get_indices(ref_patch.reshape(1, -1))[0])
+
+    def get_indices(self, ref_patches):
+        """Search the nearest patch index of each query
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D)
+
+        Returns:
+            ndarray: Indices (N,) of the matched patches
+        """
+        p_h, p_w = self._bank.patch_shape[:2]
+        s_h, s_w = self._bank.patch_spacing
+        n_h, n_w = self._bank.grid_shape
+        t_h, t_w = self._taps
+        n_freq, n_phase = self._spectrum.shape[0], self._spectrum.shape[1] // t_h
+        queries = np.asarray(ref_patches, dtype=self._patch_mat.dtype).reshape(len(ref_patches), p_h, p_w, -1)
+        chunk = max(1, CHUNK_ELEMENTS // (n_freq * max(self._spectrum.shape[1], n_h)))
+        indices = np.empty(len(queries), dtype=np.int64)
+        for start in range(0, len(queries), chunk):
+            query = queries[start:start+chunk]
+            n_q = len(query)
+            # split the queries into the same phases as the exemplar
+            padded = np.zeros((n_q, t_h*s_h, t_w*s_w, query.shape[3]), dtype=query.dtype)
+            padded[:, :p_h, :p_w] = query
+            phases = padded.reshape(n_q, t_h, s_h, t_w, s_w, -1).transpose(0, 2, 4, 5, 1, 3).reshape(n_q, n_phase, t_h, t_w)
+            # conjugate spectra along the width, then the height transform, the product with the
+            # exemplar spectra, the sum over phases and the inverse transform along the height
+            # in a single batched product per frequency
+            rows = (self._row_dft.T @ phases.reshape(-1, t_w).T).reshape(n_freq, n_q, -1)
+            spectrum = np.ascontiguousarray(np.matmul(rows, self._spectrum).transpose(1, 2, 0))
+            # inverse real transform along the width on the interleaved real and imaginary parts
+            correlation = spectrum.view(self._width_idft.dtype).reshape(n_q*n_h, -1) @ self._width_idft
+            # ||e||^2 - 2 corr, ||q||^2 does not change the order
+            distance = correlation.reshape(n_q, -1)
+            distance *= -2
+            distance += self._energy
+            indices[start:start+chunk] = np.argmin(distance, axis=1)
+        return indices
+
+    def get_patches(self, ref_patches):
+        return self._patch_mat[self.get_indices(ref_patches)]
+
+    def get_state(self):
+        return self._bank.get_state()
+
+    def set_state(self, state):
+        self._set_bank(PatchBank.from_state(state))
+
+    def _set_bank(self, bank, image=None):
+        self._bank = bank
+        self._patch_mat = bank.matrix
+        p_h, p_w = bank.patch_shape[:2]
+        s_h, s_w = bank.patch_spacing
+        n_h, n_w = bank.grid_shape
+        height, width = (n_h-1)*s_h + p_h, (n_w-1)*s_w + p_w
+        if image is None:
+            image = _grid_image(bank, (height, width))
+        image = np.asarray(image[:height, :width], dtype=bank.dtype).reshape(height, width, -1)
+
+        # energy of every patch of the grid by an integral image
+        integral = np.zeros((height+1, width+1))
+        integral[1:, 1:] = np.cumsum(np.cumsum(np.square(image, dtype=np.float64).sum(axis=2), axis=0), axis=1)
+        top = np.arange(n_h)[:, np.newaxis] * s_h
+        left = np.arange(n_w)[np.newaxis, :] * s_w
+        energy = integral[top+p_h, left+p_w] - integral[top, left+p_w] - integral[top+p_h, left] + integral[top, left]
+        self._energy = energy.ravel().astype(bank.dtype)
+
+        # phases of the grid: sub-images of the pixels at each offset inside the spacing, per channel
+        t_h, t_w = -(-p_h // s_h), -(-p_w // s_w)
+        # large enough that the circular correlation never wraps around
+        h_s, w_s = n_h + t_h - 1, n_w + t_w - 1
+        padded = np.zeros((h_s*s_h, w_s*s_w, image.shape[2]), dtype=bank.dtype)
+        padded[:height, :width] = image
+        phases = padded.reshape(h_s, s_h, w_s, s_w, -1).transpose(1, 3, 4, 0, 2).reshape(-1, h_s, w_s)
+        complex_dtype = np.result_type(bank.dtype, np.complex64)
+        spectrum = np.fft.rfft2(phases).astype(complex_dtype)
+        # inverse transforms restricted to the nonzero taps of a query give its conjugate spectrum
+        self._row_dft = np.exp(2j * np.pi * np.outer(np.arange(t_w), np.arange(w_s//2 + 1)) / w_s).astype(complex_dtype)
+        col_dft = np.exp(2j * np.pi * np.outer(np.arange(h_s), np.arange(t_h)) / h_s).astype(complex_dtype)
+        # inverse transform along the height at the rows of the grid
+        row_idft = np.exp(2j * np.pi * np.outer(np.arange(h_s), np.arange(n_h)) / h_s).astype(complex_dtype) / h_s
+        # (frequency along the width, phase * tap along the height, row of the grid)
+        self._spectrum = np.einsum('hu,phw,hy->wpuy', col_dft, spectrum, row_idft, optimize=True).reshape(w_s//2 + 1, -1, n_h)
+        # inverse real transform along the width at the columns of the grid, applied to (real, imaginary) pairs:
+        # the frequencies other than 0 and w_s/2 stand for their conjugates too
+        freq = np.arange(w_s//2 + 1)
+        scale = np.where((freq == 0) | (2*freq == w_s), 1, 2) / w_s
+        angle = 2 * np.pi * np.outer(freq, np.arange(n_w)) / w_s
+        self._width_idft = np.stack([
+            scale[:, np.newaxis] * np.cos(angle), -scale[:, np.newaxis] * np.sin(angle),
+        ], axis=1).reshape(-1, n_w).astype(bank.dtype)
+        self._taps = (t_h, t_w)
+
+
+def _grid_image(bank, shape):
+    """Image covered by the patches of a bank sampled on a grid
+
+    Pixels between patches (spacing larger than the patch) stay zero, they
+    are never under a patch of the grid.
+    """
+    p_h, p_w = bank.patch_shape[:2]
+    s_h, s_w = bank.patch_spacing
+    n_w = bank.grid_shape[1]
+    image = np.zeros(shape + bank.patch_shape[2:], dtype=bank.dtype)
+    for idx in range(len(bank)):
+        i, j = divmod(idx, n_w)
+        image[i*s_h:i*s_h+p_h, j*s_w:j*s_w+p_w] = bank.patch(idx)
+    return image
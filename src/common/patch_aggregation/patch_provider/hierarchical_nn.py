@@ -1,36 +1,165 @@
 from sklearn.cluster import KMeans
 import numpy as np
 from .patch_provider import PatchProvider
+from ..patch_bank import PatchBank, to_float_patch_bank
+
+
+def _nearest(query, candidates, candidate_sq_norm):
+    """Index of the nearest candidate of each query
+
+    Args:
+        query (ndarray): Query matrix (N, D)
+        candidates (ndarray): Candidate matrix (M, D)
+        candidate_sq_norm (ndarray): Squared norms (M,) of the candidates
+
+    Returns:
+        ndarray: Indices (N,) into the candidates
+    """
+    distance = candidate_sq_norm[np.newaxis, :] - 2 * query @ candidates.T
+    return np.argmin(distance, axis=1)
+
+
+def _group_by(keys):
+    """Yield (key, positions) for each distinct key
+    """
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    for key, start, end in zip(unique_keys, starts, ends):
+        yield key, order[start:end]
 
 
 class HierarchicalNN(PatchProvider):
     """Nearest neighbor search using hierarchical clustering
+
+    The tree is stored in flat arrays. Node i is internal when
+    first_child[i] >= 0, its children are first_child[i] + label and its
+    centroids are centroids[centroid_offset[i]:centroid_offset[i]+n_clusters].
+    A leaf owns the patches order[leaf_start[i]:leaf_end[i]] of the patch
+    bank.
     """
 
     def __init__(self, n_clusters=4, patch_amount_tol=100):
         self.n_clusters = n_clusters
         self.patch_amount_tol = patch_amount_tol
-        self.kmeans = KMeans(self.n_clusters)
-        self.children = []
-        self.candidate_patches = None
+        self._bank = None
 
     def train(self, patches):
-        self.candidate_patches = patches
-        if len(self.candidate_patches) <= self.patch_amount_tol:
-            return
-        dataset = [img.ravel() for img in patches]
-        self.kmeans.fit(dataset)
-        labels = self.kmeans.predict(dataset)
-        for i in range(self.n_clusters):
-            subset_search = HierarchicalNN(
-                n_clusters=self.n_clusters,
-                patch_amount_tol=self.patch_amount_tol)
-            subset_patches = []
-            for idx, label in enumerate(labels):
-                if label == i:
-                    subset_patches.append(self.candidate_patches[idx])
-            subset_search.train(subset_patches)
-            self.children.append(subset_search)
+        self._bank = to_float_patch_bank(patches)
+        patch_mat = self._bank.matrix
+
+        first_child = [-1]
+        centroid_offset = [-1]
+        leaf_range = [(0, 0)]
+        centroids = []
+        empty_centroids = []
+        order = []
+        # (node, indices into patch_mat)
+        stack = [(0, np.arange(len(patch_mat)))]
+        while stack:
+            node, idx = stack.pop()
+            labels = None
+            if len(idx) > self.patch_amount_tol:
+                kmeans = KMeans(self.n_clusters).fit(patch_mat[idx])
+                node_centroids = kmeans.cluster_centers_
+                labels = _nearest(patch_mat[idx], node_centroids, np.einsum('ij,ij->i', node_centroids, node_centroids))
+                # identical patches can not be split any further
+                if np.all(labels == labels[0]):
+                    labels = None
+            if labels is None:
+                leaf_range[node] = (len(order), len(order) + len(idx))
+                order.extend(idx)
+                continue
+            first_child[node] = len(first_child)
+            centroid_offset[node] = len(centroids) * self.n_clusters
+            centroids.append(node_centroids)
+            for label in range(self.n_clusters):
+                if not np.any(labels == label):
+                    empty_centroids.append(centroid_offset[node] + label)
+                first_child.append(-1)
+                centroid_offset.append(-1)
+                leaf_range.append((0, 0))
+                stack.append((first_child[node] + label, idx[labels == label]))
+
+        self._first_child = np.array(first_child)
+        self._centroid_offset = np.array(centroid_offset)
+        self._leaf_start, self._leaf_end = np.array(leaf_range).T
+        self._centroids = np.concatenate(centroids) if centroids else np.empty((0, patch_mat.shape[1]), dtype=patch_mat.dtype)
+        self._centroid_sq_norm = np.einsum('ij,ij->i', self._centroids, self._centroids)
+        # never route queries into empty clusters
+        self._centroid_sq_norm[empty_centroids] = np.inf
+        self._order = np.array(order, dtype=np.int64)
+        self._leaf_sq_norm = self._bank.sq_norm[self._order]
+
+    def get_params(self):
+        return {
+            'n_clusters': self.n_clusters,
+            'patch_amount_tol': self.patch_amount_tol,
+        }
+
+    def get_state(self):
+        return dict(
+            self._bank.get_state(),
+            first_child=self._first_child,
+            centroid_offset=self._centroid_offset,
+            leaf_start=self._leaf_start,
+            leaf_end=self._leaf_end,
+            centroids=self._centroids,
+            centroid_sq_norm=self._centroid_sq_norm,
+            order=self._order,
+        )
+
+    def set_state(self, state):
+        self._bank = PatchBank.from_state(state)
+        self._first_child = state['first_child']
+        self._centroid_offset = state['centroid_offset']
+        self._leaf_start = state['leaf_start']
+        self._leaf_end = state['leaf_end']
+        self._centroids = state['centroids']
+        self._centroid_sq_norm = state['centroid_sq_norm']
+        self._order = state['order']
+        self._leaf_sq_norm = self._bank.sq_norm[self._order]
+
+    def _search(self, ref_patches):
+        """Positions of the nearest patches in order
+        """
+        if self._bank is None:
+            raise LookupError('unable to search neighborhoods')
+        ref_patches = np.asarray(ref_patches, dtype=self._bank.dtype)
+        node = np.zeros(len(ref_patches), dtype=np.int64)
+        # route the whole batch level by level
+        active = np.flatnonzero(self._first_child[node] >= 0)
+        while len(active):
+            for parent, positions in _group_by(node[active]):
+                q_idx = active[positions]
+                c_start = self._centroid_offset[parent]
+                c_end = c_start + self.n_clusters
+                labels = _nearest(ref_patches[q_idx], self._centroids[c_start:c_end], self._centroid_sq_norm[c_start:c_end])
+                node[q_idx] = self._first_child[parent] + labels
+            active = active[self._first_child[node[active]] >= 0]
+
+        result = np.empty(len(ref_patches), dtype=np.int64)
+        for leaf, q_idx in _group_by(node):
+            start, end = self._leaf_start[leaf], self._leaf_end[leaf]
+            if start == end:
+                raise LookupError('unable to search neighborhoods')
+            leaf_mat = self._bank.matrix[self._order[start:end]]
+            result[q_idx] = start + _nearest(ref_patches[q_idx], leaf_mat, self._leaf_sq_norm[start:end])
+        return result
+
+    def get_indices(self, ref_patches):
+        """Search the nearest patch index of each query
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D)
+
+        Returns:
+            ndarray: Indices (N,) of the matched patches
+        """
+        return self._order[self._search(ref_patches)]
+
+    def get_patches(self, ref_patches):
+        return self._bank.matrix[self.get_indices(ref_patches)]
 
     def get_patch(self, ref_patch):
         return self.search(ref_patch)
@@ -41,19 +170,4 @@ class HierarchicalNN(PatchProvider):
         return __internal
 
     def search(self, patch):
-        if not self.children:
-            return self.__nearest_neighborhood(patch)
-        label = self.kmeans.predict([patch.ravel()])[0]
-        return self.children[label].search(patch)
-
-    def __nearest_neighborhood(self, patch):
-        min_distance = np.inf
-        result = None
-        if self.candidate_patches is None:
-            raise LookupError('unable to search neighborhoods')
-        for c_patch in self.candidate_patches:
-            distance = np.linalg.norm(patch-c_patch)
-            if distance < min_distance:
-                min_distance = distance
-                result = c_patch
-        return result
+        return self._bank.patch(self.get_indices(patch.reshape(1, -1))[0])
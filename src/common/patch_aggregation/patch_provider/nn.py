@@ -1,5 +1,9 @@
 from .patch_provider import PatchProvider
 import numpy as np
+from ..patch_bank import PatchBank, to_float_patch_bank
+
+# upper bound of the distance matrix elements computed at once
+CHUNK_ELEMENTS = 2**24
 
 
 class NN(PatchProvider):
@@ -10,14 +14,41 @@ class NN(PatchProvider):
     """
 
     def get_patch(self, ref_patch):
-        min_distance = np.inf
-        result = None
-        for i_patch in self._patches:
-            distance = np.linalg.norm(ref_patch-i_patch)
-            if distance < min_distance:
-                min_distance = distance
-                result = i_patch
-        return result
+        return self._bank.patch(self.get_indices(ref_patch.reshape(1, -1))[0])
+
+    def get_indices(self, ref_patches):
+        """Search the nearest patch index of each query
+
+        Distances are computed as ||a||^2 - 2ab + ||b||^2 in chunks of queries.
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D)
+
+        Returns:
+            ndarray: Indices (N,) of the matched patches
+        """
+        ref_patches = np.asarray(ref_patches, dtype=self._patch_mat.dtype)
+        chunk = max(1, CHUNK_ELEMENTS // len(self._patch_mat))
+        indices = np.empty(len(ref_patches), dtype=np.int64)
+        for start in range(0, len(ref_patches), chunk):
+            query = ref_patches[start:start+chunk]
+            distance = self._patch_sq_norm[np.newaxis, :] - 2 * query @ self._patch_mat.T
+            indices[start:start+chunk] = np.argmin(distance, axis=1)
+        return indices
+
+    def get_patches(self, ref_patches):
+        return self._patch_mat[self.get_indices(ref_patches)]
 
     def train(self, input_patches):
-        self._patches = input_patches
+        self._set_bank(to_float_patch_bank(input_patches))
+
+    def get_state(self):
+        return self._bank.get_state()
+
+    def set_state(self, state):
+        self._set_bank(PatchBank.from_state(state))
+
+    def _set_bank(self, bank):
+        self._bank = bank
+        self._patch_mat = bank.matrix
+        self._patch_sq_norm = bank.sq_norm
@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import multiprocessing
+import numpy as np
+from .patch_provider import PatchProvider
+from ..extract_patches import float_dtype
+
+
+class ParallelPatchProvider(PatchProvider):
+    """Shard batched queries of a patch provider across workers
+
+    The queries of get_patches are split into contiguous shards, one per
+    worker, and the matches are written back at the position of their
+    queries, so the result does not depend on the scheduling.
+
+    Providers keeping a search state over the grid layout (PatchMatch) are
+    not sharded: their queries run on the wrapped provider as a whole.
+
+    'thread' suits providers whose search releases the GIL (FAISS, numpy).
+    'process' forks one worker per shard for each batch: the trained
+    provider and the queries are shared copy-on-write and the matches are
+    written into a shared anonymous mapping, so nothing is pickled.
+    Do not use 'process' with FAISS, OpenMP does not survive fork.
+
+    Args:
+        patch_provider (PatchProvider): Provider to be parallelized
+        n_jobs (int): Number of workers
+        backend (str, optional): 'thread' or 'process'. Defaults to 'thread'.
+    """
+
+    def __init__(self, patch_provider, n_jobs, backend='thread'):
+        if backend not in ('thread', 'process'):
+            raise ValueError(f'Unknown backend: {backend}')
+        if backend == 'process' and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('Process backend requires fork')
+        self.patch_provider = patch_provider
+        self.n_jobs = n_jobs
+        self.backend = backend
+
+    @property
+    def uses_grid_layout(self):
+        return self.patch_provider.uses_grid_layout
+
+    def train(self, input_patches):
+        self.patch_provider.train(input_patches)
+
+    def get_patch(self, ref_patch):
+        return self.patch_provider.get_patch(ref_patch)
+
+    def get_patches_on_grid(self, patch_grid):
+        # providers keeping a search state over the grid are not sharded
+        if self.patch_provider.uses_grid_layout:
+            return self.patch_provider.get_patches_on_grid(patch_grid)
+        return self.get_patches(patch_grid.to_matrix())
+
+    def warm_started(self, previous, scale=1):
+        if isinstance(previous, ParallelPatchProvider):
+            previous = previous.patch_provider
+        return self._wrap(self.patch_provider.warm_started(previous, scale))
+
+    def seeded(self, rng):
+        return self._wrap(self.patch_provider.seeded(rng))
+
+    def get_search_state(self):
+        return self.patch_provider.get_search_state()
+
+    def set_search_state(self, state):
+        self.patch_provider.set_search_state(state)
+
+    def _wrap(self, patch_provider):
+        # stateless providers return themselves: keep the wrapper, match caches key on its identity
+        if patch_provider is self.patch_provider:
+            return self
+        return ParallelPatchProvider(patch_provider, self.n_jobs, self.backend)
+
+    def get_patches(self, ref_patches):
+        if self.patch_provider.uses_grid_layout:
+            # shards would search concurrently with the same field
+            return self.patch_provider.get_patches(ref_patches)
+        bounds = np.linspace(0, len(ref_patches), self.n_jobs+1).astype(np.int64)
+        shards = [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+        if len(shards) <= 1:
+            return self.patch_provider.get_patches(ref_patches)
+        if self.backend == 'thread':
+            with ThreadPoolExecutor(len(shards)) as executor:
+                results = executor.map(lambda shard: self.patch_provider.get_patches(ref_patches[shard[0]:shard[1]]), shards)
+                return np.concatenate(list(results))
+        return self._get_patches_by_fork(ref_patches, shards)
+
+    def _get_patches_by_fork(self, ref_patches, shards):
+        shape = (len(ref_patches), ref_patches.shape[1])
+        dtype = float_dtype(ref_patches.dtype)
+        buffer = mmap.mmap(-1, int(np.prod(shape)) * dtype.itemsize)
+        result = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+        def match(start, end):
+            result[start:end] = self.patch_provider.get_patches(ref_patches[start:end])
+
+        context = multiprocessing.get_context('fork')
+        workers = [context.Process(target=match, args=shard) for shard in shards]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError('Patch search failed in a worker process')
+        result = result.copy()
+        buffer.close()
+        return result
@@ -0,0 +1,173 @@
+import copy
+import numpy as np
+from .patch_provider import PatchProvider
+from ..patch_bank import PatchBank, to_float_patch_bank
+
+# propagation directions (cells on the target grid)
+DIRECTIONS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+class PatchMatch(PatchProvider):
+    """Nearest neighbor field search by PatchMatch
+
+    Each target patch on the query grid keeps its match (the nearest
+    neighbor field). Every query refines the field of the previous query
+    by propagating matches of the neighboring target patches and by a
+    random search around the current match, so the cost is linear in the
+    number of target patches and almost independent of the exemplar size.
+    warm_started() carries the field over to the next patch size or
+    pyramid layer.
+
+    Args:
+        n_iteration (int, optional): Propagation and random search rounds per query. Defaults to 2.
+        alpha (float, optional): Shrink ratio of the random search radius. Defaults to 0.5.
+    """
+
+    uses_grid_layout = True
+
+    def __init__(self, n_iteration=2, alpha=0.5):
+        self.n_iteration = n_iteration
+        self.alpha = alpha
+        self._cells = None
+        self._grid = None
+        self._previous = None
+
+    def train(self, input_patches):
+        if getattr(input_patches, 'grid_shape', None) is None:
+            raise ValueError('PatchMatch requires the patches as a PatchGrid or a PatchBank sampled on a grid')
+        self._set_bank(to_float_patch_bank(input_patches))
+
+    def get_patch(self, ref_patch):
+        distance = self._patch_sq_norm - 2 * self._patch_mat @ ref_patch.ravel()
+        return self._bank.patch(np.argmin(distance))
+
+    def get_patches(self, ref_patches):
+        # no layout: the queries are treated as a single column
+        cells = self._search(ref_patches, (len(ref_patches), 1), (0, 0), self._bank.patch_shape[:2])
+        return self._patch_mat[self._flat_indices(cells).ravel()]
+
+    def get_patches_on_grid(self, patch_grid):
+        cells = self._search(patch_grid.to_matrix(), patch_grid.grid_shape, patch_grid.patch_spacing, patch_grid.patch_size)
+        return self._patch_mat[self._flat_indices(cells).ravel()]
+
+    def warm_started(self, previous, scale=1):
+        provider = copy.copy(self)
+        provider._cells = None
+        provider._grid = None
+        provider._previous = None
+        if isinstance(previous, PatchMatch) and previous._cells is not None:
+            provider._previous = (previous._grid, previous._displacement(), scale)
+        return provider
+
+    def seeded(self, rng):
+        provider = copy.copy(self)
+        provider.rng = rng
+        return provider
+
+    def get_params(self):
+        return {
+            'n_iteration': self.n_iteration,
+            'alpha': self.alpha,
+        }
+
+    def get_state(self):
+        return self._bank.get_state()
+
+    def set_state(self, state):
+        self._set_bank(PatchBank.from_state(state))
+
+    def _set_bank(self, bank):
+        self._bank = bank
+        self._patch_mat = bank.matrix
+        self._patch_sq_norm = bank.sq_norm
+        self._exemplar_grid_shape = np.array(bank.grid_shape)
+        self._exemplar_spacing = np.array(bank.patch_spacing)
+        self._cells = None
+
+    def get_search_state(self):
+        if self._cells is None:
+            return {}
+        grid_shape, spacing, patch_size = self._grid
+        return {'cells': self._cells, 'grid': np.array([grid_shape, spacing, patch_size])}
+
+    def set_search_state(self, state):
+        if 'cells' in state:
+            self._cells = np.asarray(state['cells'])
+            self._grid = tuple(tuple(int(v) for v in row) for row in state['grid'])
+
+    def _random_integers(self, low, high, size):
+        if self.rng is None:
+            return np.random.randint(low, high, size=size)
+        return self.rng.integers(low, high, size=size)
+
+    def _flat_indices(self, cells):
+        return cells[..., 0] * self._exemplar_grid_shape[1] + cells[..., 1]
+
+    def _clip(self, cells):
+        return np.clip(cells, 0, self._exemplar_grid_shape - 1)
+
+    def _distance(self, query, query_sq_norm, cells):
+        idx = self._flat_indices(cells).ravel()
+        distance = query_sq_norm - 2 * np.einsum('ij,ij->i', query, self._patch_mat[idx]) + self._patch_sq_norm[idx]
+        return distance.reshape(cells.shape[:2])
+
+    def _displacement(self):
+        """Exemplar minus target position (pixels) of each target patch
+        """
+        grid_shape, spacing, _ = self._grid
+        target = np.stack(np.meshgrid(np.arange(grid_shape[0]), np.arange(grid_shape[1]), indexing='ij'), axis=-1) * np.array(spacing)
+        return self._cells * self._exemplar_spacing - target
+
+    def _initial_cells(self, grid_shape, spacing, patch_size):
+        if self._cells is not None and self._grid == (grid_shape, spacing, patch_size):
+            return self._cells
+        if self._previous is None:
+            return self._random_integers(0, self._exemplar_grid_shape, grid_shape + (2,))
+
+        # look up the previous field at the center of each target patch
+        (pre_grid_shape, pre_spacing, pre_patch_size), pre_displacement, scale = self._previous
+        idx = np.stack(np.meshgrid(np.arange(grid_shape[0]), np.arange(grid_shape[1]), indexing='ij'), axis=-1)
+        target = idx * np.array(spacing)
+        center = (target + np.array(patch_size) / 2) / scale
+        pre_idx = np.rint((center - np.array(pre_patch_size) / 2) / np.maximum(pre_spacing, 1)).astype(np.int64)
+        pre_idx = np.clip(pre_idx, 0, np.array(pre_grid_shape) - 1)
+        displacement = pre_displacement[pre_idx[..., 0], pre_idx[..., 1]] * scale
+        return self._clip(np.rint((target + displacement) / self._exemplar_spacing).astype(np.int64))
+
+    def _search(self, query, grid_shape, spacing, patch_size):
+        """Refine the nearest neighbor field
+
+        Returns:
+            ndarray: Exemplar grid cell (n_h, n_w, 2) matched to each target patch
+        """
+        grid_shape, spacing, patch_size = tuple(grid_shape), tuple(spacing), tuple(patch_size)
+        query = np.asarray(query, dtype=self._patch_mat.dtype)
+        query_sq_norm = np.einsum('ij,ij->i', query, query)
+        cells = self._initial_cells(grid_shape, spacing, patch_size)
+        best = self._distance(query, query_sq_norm, cells)
+        n_h, n_w = grid_shape
+
+        def improve(candidate):
+            distance = self._distance(query, query_sq_norm, candidate)
+            better = distance < best
+            cells[better] = candidate[better]
+            best[better] = distance[better]
+
+        for _ in range(self.n_iteration):
+            # propagation: the match of the neighbor shifted by one target step
+            for di, dj in DIRECTIONS:
+                shift = np.rint(np.array([di * spacing[0], dj * spacing[1]]) / self._exemplar_spacing).astype(np.int64)
+                candidate = cells.copy()
+                candidate[max(di, 0):n_h+min(di, 0), max(dj, 0):n_w+min(dj, 0)] = \
+                    cells[max(-di, 0):n_h-max(di, 0), max(-dj, 0):n_w-max(dj, 0)] + shift
+                improve(self._clip(candidate))
+            # random search with exponentially shrinking radius
+            radius = int(self._exemplar_grid_shape.max())
+            while radius >= 1:
+                offset = self._random_integers(-radius, radius + 1, cells.shape)
+                improve(self._clip(cells + offset))
+                radius = int(radius * self.alpha)
+
+        self._cells = cells
+        self._grid = (grid_shape, spacing, patch_size)
+        return cells
@@ -2,10 +2,107 @@ import abc
 
 
 class PatchProvider(metaclass=abc.ABCMeta):
+    # True when get_patches_on_grid makes use of the layout of the queries
+    uses_grid_layout = False
+    # np.random.Generator of the random choices, the global generators when None
+    rng = None
+
     @abc.abstractmethod
     def get_patch(self, ref_patch):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_patches(self, ref_patches):
+        """Batched version of get_patch
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D), one raveled patch per row
+
+        Returns:
+            ndarray: Matched patches (N, D), one raveled patch per row
+        """
+        raise NotImplementedError
+
+    def get_patches_on_grid(self, patch_grid):
+        """Batched query of the patches sampled on a grid
+
+        Args:
+            patch_grid (PatchGrid): Patches to be queried
+
+        Returns:
+            ndarray: Matched patches (N, D), one raveled patch per row
+        """
+        return self.get_patches(patch_grid.to_matrix())
+
+    def warm_started(self, previous, scale=1):
+        """Provider to be used after previous
+
+        Stateless providers return themselves. Providers keeping a search
+        state return a copy whose state is initialized from previous.
+
+        Args:
+            previous (PatchProvider): Provider used in the previous stage (or None)
+            scale (int, optional): Scale of the target image relative to the previous stage. Defaults to 1.
+
+        Returns:
+            PatchProvider: Provider for the next stage
+        """
+        return self
+
+    def seeded(self, rng):
+        """Provider drawing its random choices from rng
+
+        Deterministic providers return themselves. Randomized providers
+        return a copy, so that concurrent runs (e.g. tiles) do not share
+        the global generators.
+
+        Args:
+            rng (np.random.Generator): Generator
+
+        Returns:
+            PatchProvider: Provider using rng
+        """
+        return self
+
+    def get_search_state(self):
+        """Search state carried to the next stage by warm_started()
+
+        Returns:
+            dict of ndarray: State which can be restored by set_search_state (empty for stateless providers)
+        """
+        return {}
+
+    def set_search_state(self, state):
+        """Restore the search state of a completed stage (e.g. when resuming a run)
+
+        Args:
+            state (dict of ndarray): State returned by get_search_state
+        """
+
     @abc.abstractmethod
     def train(self, input_patches):
         raise NotImplementedError
+
+    def get_params(self):
+        """Parameters the provider was built with
+
+        Returns:
+            dict: Parameters (used to identify a trained provider)
+        """
+        return {}
+
+    def get_state(self):
+        """Trained state
+
+        Returns:
+            dict of ndarray: State which can be restored by set_state
+        """
+        raise NotImplementedError
+
+    def set_state(self, state):
+        """Restore the trained state instead of training
+
+        Args:
+            state (dict of ndarray): State returned by get_state
+        """
+        raise NotImplementedError
@@ -0,0 +1,117 @@
+from .patch_provider import PatchProvider
+import faiss
+import numpy as np
+from ..patch_bank import PatchBank, to_patch_bank
+
+# faiss warns when an inverted list gets fewer training points than this
+MIN_POINTS_PER_CENTROID = 39
+
+
+class PCAANN(PatchProvider):
+    """Approximate nearest neighbor search in a PCA-projected patch space using FAISS
+
+    Patches are projected onto their principal components, and the reduced
+    vectors are indexed by an IVF or HNSW index.
+
+    Args:
+        n_components (int, optional): Number of principal components. Defaults to 64.
+        index_type (str, optional): 'IVF' or 'HNSW'. Defaults to 'IVF'.
+        nlist (int, optional): Number of inverted lists (IVF). Defaults to 100.
+        nprobe (int, optional): Number of inverted lists visited per query (IVF). Defaults to 8.
+        hnsw_m (int, optional): Number of neighbors per graph node (HNSW). Defaults to 32.
+        ef_search (int, optional): Size of the candidate list at search time (HNSW). Defaults to 64.
+    """
+
+    def __init__(self, n_components=64, index_type='IVF', nlist=100, nprobe=8, hnsw_m=32, ef_search=64):
+        if index_type not in ('IVF', 'HNSW'):
+            raise ValueError(f'Unknown index type: {index_type}')
+        self.n_components = n_components
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+
+    def train(self, patches):
+        self._bank = to_patch_bank(patches)
+        self._patch_mat = self._bank.matrix
+        data = np.ascontiguousarray(self._patch_mat, dtype=np.float32)
+        # PCA can not output more components than there are patches
+        n_components = min(self.n_components, data.shape[1], len(data))
+        pca = faiss.PCAMatrix(data.shape[1], n_components)
+        if self.index_type == 'IVF':
+            nlist = max(1, min(self.nlist, len(data) // MIN_POINTS_PER_CENTROID))
+            quantizer = faiss.IndexFlatL2(n_components)
+            sub_index = faiss.IndexIVFFlat(quantizer, n_components, nlist)
+        else:
+            sub_index = faiss.IndexHNSWFlat(n_components, self.hnsw_m)
+        self._index = faiss.IndexPreTransform(pca, sub_index)
+        self._index.train(data)
+        self._index.add(data)
+        self.set_search_params()
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Update the recall/speed knobs of the trained index
+
+        Args:
+            nprobe (int, optional): Number of inverted lists visited per query (IVF)
+            ef_search (int, optional): Size of the candidate list at search time (HNSW)
+        """
+        if nprobe is not None:
+            self.nprobe = nprobe
+        if ef_search is not None:
+            self.ef_search = ef_search
+        params = faiss.ParameterSpace()
+        if self.index_type == 'IVF':
+            params.set_index_parameter(self._index, 'nprobe', self.nprobe)
+        else:
+            params.set_index_parameter(self._index, 'efSearch', self.ef_search)
+
+    def get_patch(self, ref_patch):
+        return self._bank.patch(self.get_indices(ref_patch.reshape(1, -1))[0])
+
+    def get_indices(self, ref_patches):
+        """Search the approximate nearest patch index of each query
+
+        Args:
+            ref_patches (ndarray): Query matrix (N, D)
+
+        Returns:
+            ndarray: Indices (N,) of the matched patches
+        """
+        query = np.ascontiguousarray(ref_patches, dtype=np.float32)
+        distance, indices = self._index.search(query, k=1)
+        indices = indices[:, 0]
+        # the visited inverted lists can be empty, fall back to an exhaustive probe
+        missing = indices < 0
+        if self.index_type == 'IVF' and missing.any():
+            # per-call parameters, the index may be searched by other threads
+            ivf_params = faiss.SearchParametersIVF(nprobe=faiss.extract_index_ivf(self._index).nlist)
+            params = faiss.SearchParametersPreTransform(index_params=ivf_params)
+            distance, found = self._index.search(query[missing], k=1, params=params)
+            indices[missing] = found[:, 0]
+        if (indices < 0).any():
+            raise RuntimeError('No patch found for some queries')
+        return indices
+
+    def get_patches(self, ref_patches):
+        return self._patch_mat[self.get_indices(ref_patches)]
+
+    def get_params(self):
+        return {
+            'n_components': self.n_components,
+            'index_type': self.index_type,
+            'nlist': self.nlist,
+            'nprobe': self.nprobe,
+            'hnsw_m': self.hnsw_m,
+            'ef_search': self.ef_search,
+        }
+
+    def get_state(self):
+        return dict(self._bank.get_state(), index=faiss.serialize_index(self._index))
+
+    def set_state(self, state):
+        self._bank = PatchBank.from_state(state)
+        self._patch_mat = self._bank.matrix
+        self._index = faiss.deserialize_index(state['index'])
+        self.set_search_params()
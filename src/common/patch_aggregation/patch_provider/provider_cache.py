@@ -0,0 +1,129 @@
+from collections import OrderedDict
+import hashlib
+import os
+import threading
+import numpy as np
+from ..extract_patches import PatchGrid
+
+
+class ProviderCache:
+    """Cache of trained patch providers
+
+    Trained providers are keyed by the exemplar content (one pyramid level),
+    the patch size/spacing and the provider type and parameters. The most
+    recently used providers are kept in memory, and when cache_dir is given
+    their trained state is persisted there so that other runs skip training.
+    The cache can be shared by threads; a provider missing in memory may be
+    trained by more than one of them.
+
+    Args:
+        cache_dir (str, optional): Directory to persist trained states. Defaults to None (memory only).
+        max_entries (int, optional): Number of providers kept in memory. Defaults to 16.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=16):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(exemplar, patch_size, patch_spacing, patch_provider):
+        """Cache key of a trained provider
+
+        Args:
+            exemplar (ndarray): Image the patches are extracted from
+            patch_size (int, int): Patch size
+            patch_spacing (int, int): Patch sampling gap
+            patch_provider (PatchProvider): Untrained provider
+
+        Returns:
+            str: Hex digest
+        """
+        digest = hashlib.sha1(np.ascontiguousarray(exemplar).tobytes())
+        digest.update(repr((
+            exemplar.shape,
+            str(exemplar.dtype),
+            tuple(patch_size),
+            tuple(patch_spacing),
+            type(patch_provider).__name__,
+            sorted(patch_provider.get_params().items()),
+        )).encode())
+        return digest.hexdigest()
+
+    def get_provider(self, builder, exemplar, patch_size, patch_spacing):
+        """Get a trained provider, training it only on a cache miss
+
+        Args:
+            builder (callable): Returns an untrained provider
+            exemplar (ndarray): Image the patches are extracted from
+            patch_size (int, int): Patch size
+            patch_spacing (int, int): Patch sampling gap
+
+        Returns:
+            PatchProvider: Trained provider
+        """
+        patch_provider = builder()
+        key = self.make_key(exemplar, patch_size, patch_spacing, patch_provider)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        path = self._path(key)
+        disk_hit = path is not None and os.path.exists(path)
+        if disk_hit:
+            with np.load(path) as state:
+                patch_provider.set_state(dict(state))
+        else:
+            patch_provider.train(PatchGrid(exemplar, patch_size, patch_spacing))
+            if path is not None:
+                self._save(path, patch_provider.get_state())
+        with self._lock:
+            if disk_hit:
+                self.disk_hits += 1
+            else:
+                self.misses += 1
+            self._entries[key] = patch_provider
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return patch_provider
+
+    def stats(self):
+        """Hit/miss counters
+
+        Returns:
+            dict: hits (memory), disk_hits, misses and number of entries in memory
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+    def clear(self):
+        """Drop the providers kept in memory (persisted states are kept)
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    @staticmethod
+    def _save(path, state):
+        # write then rename so that concurrent readers never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **state)
+        os.replace(tmp_path, path)
@@ -1,10 +1,36 @@
+import copy
 import random
+import numpy as np
+from ..patch_bank import PatchBank, to_patch_bank
 from .patch_provider import PatchProvider
 
 
 class RandomPick(PatchProvider):
     def get_patch(self, _):
-        return random.choice(self._patches)
+        if self.rng is not None:
+            return self._bank.patch(self.rng.integers(len(self._bank)))
+        return self._bank.patch(random.randrange(len(self._bank)))
+
+    def get_indices(self, ref_patches):
+        if self.rng is not None:
+            return self.rng.integers(len(self._bank), size=len(ref_patches), dtype=np.int64)
+        return np.array(random.choices(range(len(self._bank)), k=len(ref_patches)), dtype=np.int64)
+
+    def seeded(self, rng):
+        provider = copy.copy(self)
+        provider.rng = rng
+        return provider
+
+    def get_patches(self, ref_patches):
+        return self._patch_mat[self.get_indices(ref_patches)]
 
     def train(self, input_patches):
-        self._patches = input_patches
+        self._bank = to_patch_bank(input_patches)
+        self._patch_mat = self._bank.matrix
+
+    def get_state(self):
+        return self._bank.get_state()
+
+    def set_state(self, state):
+        self._bank = PatchBank.from_state(state)
+        self._patch_mat = self._bank.matrix
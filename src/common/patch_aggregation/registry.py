@@ -0,0 +1,86 @@
+import importlib
+
+# name: (module relative to this package, attribute)
+# modules are imported on first use, so only the backends in use pay for their dependencies (faiss, sklearn, numba)
+PROVIDERS = {
+    'RandomPick': ('.patch_provider.random_pick', 'RandomPick'),
+    'HierarchicalNN': ('.patch_provider.hierarchical_nn', 'HierarchicalNN'),
+    'NN': ('.patch_provider.nn', 'NN'),
+    'FaissANN': ('.patch_provider.faiss_ann', 'FaissANN'),
+    'PCAANN': ('.patch_provider.pca_ann', 'PCAANN'),
+    'PatchMatch': ('.patch_provider.patch_match', 'PatchMatch'),
+    'FFTNN': ('.patch_provider.fft_nn', 'FFTNN'),
+}
+
+AGGREGATORS = {
+    'l2': ('.patch_aggregate', 'l2_norm_aggregate'),
+    'lp_irls': ('.patch_aggregate', 'lp_norm_irls_aggregate'),
+}
+
+
+def _resolve(table, kind, name):
+    if name not in table:
+        raise ValueError(f'Unknown {kind}: {name}')
+    target = table[name]
+    if isinstance(target, tuple):
+        module, attribute = target
+        target = getattr(importlib.import_module(module, __package__), attribute)
+        table[name] = target
+    return target
+
+
+def register_provider(name, target):
+    """Register a patch provider
+
+    Args:
+        name (str): Name the provider is resolved by
+        target (type or (str, str)): Provider class, or (absolute module, class name) imported on first use
+    """
+    PROVIDERS[name] = target
+
+
+def register_aggregator(name, target):
+    """Register a patch aggregator
+
+    Args:
+        name (str): Name the aggregator is resolved by
+        target (callable or (str, str)): Aggregator, or (absolute module, function name) imported on first use
+    """
+    AGGREGATORS[name] = target
+
+
+def provider_class(name):
+    """Patch provider class, imported on first use
+
+    Args:
+        name (str): Registered name, e.g. 'HierarchicalNN'
+
+    Returns:
+        type: Provider class
+    """
+    return _resolve(PROVIDERS, 'provider', name)
+
+
+def create_provider(name, *args, **kwargs):
+    """Build a patch provider by name
+
+    Args:
+        name (str): Registered name, e.g. 'HierarchicalNN'
+        *args, **kwargs: Arguments of the provider
+
+    Returns:
+        PatchProvider: Untrained provider
+    """
+    return provider_class(name)(*args, **kwargs)
+
+
+def get_aggregator(name):
+    """Patch aggregator, imported on first use
+
+    Args:
+        name (str): Registered name, e.g. 'lp_irls'
+
+    Returns:
+        callable: Aggregator
+    """
+    return _resolve(AGGREGATORS, 'aggregator', name)
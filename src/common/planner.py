@@ -0,0 +1,233 @@
+import math
+
+# upper bound of the distance matrix elements NN computes at once (patch_provider/nn.py)
+NN_CHUNK_ELEMENTS = 2**24
+
+# upper bound of the spectrum elements FFTNN computes at once (patch_provider/fft_nn.py)
+FFT_CHUNK_ELEMENTS = 2**20
+
+# float32 copies kept by the FAISS indexes
+FAISS_ITEMSIZE = 4
+
+# propagation directions of PatchMatch per iteration
+PATCH_MATCH_DIRECTIONS = 4
+
+
+def pyramid_shapes(shape, resolution_layer):
+    """Shapes of the layers of get_pyramid, coarsest first
+
+    Args:
+        shape (tuple): Shape of the original image
+        resolution_layer (int): Number of layers
+
+    Returns:
+        list of tuple: Layer shapes
+    """
+    shapes = [tuple(shape)]
+    for _ in range(resolution_layer-1):
+        h, w = shapes[-1][:2]
+        # cv2.pyrDown rounds up
+        shapes.append(((h+1) // 2, (w+1) // 2) + shapes[-1][2:])
+    return shapes[::-1]
+
+
+def grid_shape(shape, patch_size, patch_spacing):
+    """Shape of the grid of patches sampled from an image
+
+    Returns:
+        (int, int): Number of patches along the height and the width
+    """
+    n_h = max(0, (shape[0] - patch_size[0]) // patch_spacing[0] + 1)
+    n_w = max(0, (shape[1] - patch_size[1]) // patch_spacing[1] + 1)
+    return n_h, n_w
+
+
+def grid_size(shape, patch_size, patch_spacing):
+    """Number of patches of the grid sampled from an image
+
+    Returns:
+        int: Number of patches
+    """
+    n_h, n_w = grid_shape(shape, patch_size, patch_spacing)
+    return n_h * n_w
+
+
+def estimate_provider(name, params, n_patches, dim, n_queries, itemsize, grid_shape=None, patch_size=None, patch_spacing=None):
+    """Memory and query cost of a trained provider
+
+    The bank (exemplar patch matrix) is reported apart from the index
+    structures, since it can be memory-mapped.
+
+    Args:
+        name (str): Provider name, e.g. 'HierarchicalNN'
+        params (dict): get_params() of the provider
+        n_patches (int): Number of exemplar patches
+        dim (int): Patch dimensionality
+        n_queries (int): Number of target patches queried at once
+        itemsize (int): Bytes per element of the pipeline dtype
+        grid_shape (int, int, optional): Exemplar grid shape, used by FFTNN
+        patch_size (int, int, optional): Patch size, used by FFTNN
+        patch_spacing (int, int, optional): Patch spacing, used by FFTNN
+
+    Returns:
+        dict: 'bank_memory', 'index_memory', 'query_memory' (bytes) and 'query_cost' (multiply-adds per query of all the target patches)
+    """
+    bank_memory = n_patches * dim * itemsize
+    sq_norm = n_patches * itemsize
+    index_memory, query_memory = 0, 0
+    if name == 'NN':
+        index_memory = sq_norm
+        query_memory = min(n_queries * n_patches, max(NN_CHUNK_ELEMENTS, n_patches)) * itemsize
+        query_cost = n_queries * n_patches * dim
+    elif name == 'HierarchicalNN':
+        n_clusters, tol = params.get('n_clusters', 4), params.get('patch_amount_tol', 100)
+        depth = math.ceil(math.log(max(n_patches / tol, 1), n_clusters)) if n_clusters > 1 else 0
+        n_centroids = n_clusters * (n_clusters**depth - 1) // max(n_clusters - 1, 1)
+        # centroids, leaf order and the squared norms of patches and centroids
+        index_memory = n_centroids * (dim + 1) * itemsize + n_patches * (8 + itemsize) + sq_norm
+        query_cost = n_queries * (depth * n_clusters + min(tol, n_patches)) * dim
+    elif name == 'FaissANN':
+        index_memory = n_patches * dim * FAISS_ITEMSIZE
+        query_cost = n_queries * n_patches * dim
+    elif name == 'PCAANN':
+        k = min(params.get('n_components', 64), dim, n_patches)
+        index_memory = (n_patches + dim) * k * FAISS_ITEMSIZE
+        if params.get('index_type', 'IVF') == 'IVF':
+            nlist = max(1, min(params.get('nlist', 100), n_patches))
+            index_memory += nlist * k * FAISS_ITEMSIZE + n_patches * 8
+            query_cost = n_queries * (dim * k + nlist * k + min(params.get('nprobe', 8), nlist) * n_patches // nlist * k)
+        else:
+            hnsw_m = params.get('hnsw_m', 32)
+            # graph links, twice as many on the bottom layer
+            index_memory += n_patches * 2 * hnsw_m * 4
+            query_cost = n_queries * (dim * k + params.get('ef_search', 64) * hnsw_m * k)
+    elif name == 'FFTNN':
+        # square grid with spacing 1 when the layout is not given
+        n_h, n_w = grid_shape or (max(1, math.isqrt(n_patches)),) * 2
+        p_h, p_w = patch_size or (max(1, math.isqrt(dim)),) * 2
+        s_h, s_w = patch_spacing or (1, 1)
+        t_h, t_w = -(-p_h // s_h), -(-p_w // s_w)
+        n_freq = (n_w + t_w - 1) // 2 + 1
+        # polyphase rows of the spectrum: spacing offsets * channels * taps along the height
+        n_rows = s_h * s_w * (dim // (p_h * p_w) or 1) * t_h
+        # complex spectrum, inverse transform along the width and the patch energies
+        index_memory = n_freq * n_rows * n_h * 2 * itemsize + 2 * n_freq * n_w * itemsize + sq_norm
+        query_memory = 2 * min(n_queries * n_freq * max(n_rows, n_h), max(FFT_CHUNK_ELEMENTS, n_freq * max(n_rows, n_h))) * 2 * itemsize
+        # complex products count four multiply-adds
+        query_cost = n_queries * (4 * n_freq * n_rows * (t_w + n_h) + 2 * n_freq * n_h * n_w)
+    elif name == 'PatchMatch':
+        # nearest neighbor field of the target grid
+        index_memory = sq_norm + n_queries * 2 * 8
+        alpha = params.get('alpha', 0.5)
+        random_search = math.floor(math.log(max(n_patches, 1)) / -math.log(alpha)) + 1 if 0 < alpha < 1 else 1
+        query_cost = n_queries * dim * (1 + params.get('n_iteration', 2) * (PATCH_MATCH_DIRECTIONS + random_search))
+    else:
+        query_cost = n_queries * dim
+    return {
+        'bank_memory': bank_memory,
+        'index_memory': index_memory,
+        'query_memory': query_memory,
+        'query_cost': query_cost,
+    }
+
+
+def plan_stages(stages, provider_name, provider_params, itemsize, memory_mapped=False):
+    """Patch counts, memory and query cost of the stages of a run
+
+    The providers of all the stages are trained before the run and kept
+    until it ends, so their memory adds up. The matches of one stage are
+    alive at a time.
+
+    Args:
+        stages (list of dict): 'layer', 'setting' (patch setting index), 'patch_size', 'patch_spacing',
+            'exemplar_shape', 'target_shape' and 'iteration' of each stage
+        provider_name (str): Provider name
+        provider_params (dict): get_params() of the provider
+        itemsize (int): Bytes per element of the pipeline dtype
+        memory_mapped (bool, optional): Banks are memory-mapped files (not resident). Defaults to False.
+
+    Returns:
+        dict: 'provider', 'stages' (one dict per stage), 'resident_memory' (bytes kept by the providers),
+            'disk_memory' (bytes of the memory-mapped banks), 'peak_memory' (bytes) and 'query_cost' (multiply-adds)
+    """
+    planned = []
+    for stage in stages:
+        patch_size, patch_spacing = stage['patch_size'], stage['patch_spacing']
+        channels = stage['exemplar_shape'][2] if len(stage['exemplar_shape']) == 3 else 1
+        dim = patch_size[0] * patch_size[1] * channels
+        exemplar_grid = grid_shape(stage['exemplar_shape'], patch_size, patch_spacing)
+        exemplar_patches = exemplar_grid[0] * exemplar_grid[1]
+        target_patches = grid_size(stage['target_shape'], patch_size, patch_spacing)
+        estimate = estimate_provider(
+            provider_name, provider_params, exemplar_patches, dim, target_patches, itemsize,
+            grid_shape=exemplar_grid, patch_size=patch_size, patch_spacing=patch_spacing,
+        )
+        planned.append(dict(
+            stage,
+            dim=dim,
+            exemplar_patches=exemplar_patches,
+            target_patches=target_patches,
+            bank_memory=estimate['bank_memory'],
+            index_memory=estimate['index_memory'],
+            query_memory=estimate['query_memory'],
+            # queries and matches of the target grid
+            match_memory=2 * target_patches * dim * itemsize,
+            query_cost=estimate['query_cost'] * stage['iteration'],
+        ))
+    bank_memory = sum(stage['bank_memory'] for stage in planned)
+    resident_memory = sum(stage['index_memory'] for stage in planned) + (0 if memory_mapped else bank_memory)
+    working_memory = max((stage['match_memory'] + stage['query_memory'] for stage in planned), default=0)
+    return {
+        'provider': provider_name,
+        'stages': planned,
+        'resident_memory': resident_memory,
+        'disk_memory': bank_memory if memory_mapped else 0,
+        'peak_memory': resident_memory + working_memory,
+        'query_cost': sum(stage['query_cost'] for stage in planned),
+    }
+
+
+def fit_memory_budget(make_stages, patch_size_list, patch_spacing_list, candidates, memory_budget, itemsize, memory_mapped=False):
+    """Patch spacings and provider whose plan fits in a memory budget
+
+    For each candidate provider the spacing of the patch setting with the
+    largest memory is doubled (up to the patch size, so that the target
+    stays covered) until the plan fits. The candidate needing the fewest
+    doublings wins, the earlier one on ties.
+
+    Args:
+        make_stages (callable): Returns the stages (see plan_stages) of a list of patch spacings
+        patch_size_list (list of (int, int)): Patch sizes
+        patch_spacing_list (list of (int, int)): Current patch spacings
+        candidates (list of (str, dict)): Provider names and parameters, the current provider first
+        memory_budget (int): Peak memory allowed (bytes)
+        itemsize (int): Bytes per element of the pipeline dtype
+        memory_mapped (bool, optional): Banks are memory-mapped files (not resident). Defaults to False.
+
+    Returns:
+        ((str, dict), list of (int, int), dict): Provider, patch spacings and plan, or None when nothing fits
+    """
+    best = None
+    for name, params in candidates:
+        spacing_list = [tuple(spacing) for spacing in patch_spacing_list]
+        steps = 0
+        while True:
+            plan = plan_stages(make_stages(spacing_list), name, params, itemsize, memory_mapped)
+            if plan['peak_memory'] <= memory_budget:
+                if best is None or steps < best[0]:
+                    best = (steps, (name, params), spacing_list, plan)
+                break
+            # memory of each patch setting over the layers
+            setting_memory = {}
+            for stage in plan['stages']:
+                p_idx = stage['setting']
+                setting_memory[p_idx] = setting_memory.get(p_idx, 0) + stage['bank_memory'] + stage['index_memory']
+            coarsenable = [p_idx for p_idx in setting_memory if any(s < p for s, p in zip(spacing_list[p_idx], patch_size_list[p_idx]))]
+            if not coarsenable:
+                break
+            p_idx = max(coarsenable, key=setting_memory.get)
+            spacing_list[p_idx] = tuple(max(s, min(2 * s, p)) for s, p in zip(spacing_list[p_idx], patch_size_list[p_idx]))
+            steps += 1
+    if best is None:
+        return None
+    return best[1:]
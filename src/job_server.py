@@ -0,0 +1,330 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import base64
+import binascii
+import itertools
+import json
+import time
+import cv2
+import numpy as np
+from .common.metrics import Metrics
+from .common.patch_aggregation.patch_provider import ProviderCache
+from .style_transfer import StyleTransfer, WeightMatBuilder
+from .texture_synthesis import TextureSynthesis
+
+REASONS = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 503: 'Service Unavailable'}
+
+# number of finished jobs the latency statistics are computed over
+LATENCY_WINDOW = 1000
+
+
+class JobError(Exception):
+    """Invalid request, answered with an HTTP error status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Job:
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.status = 'queued'
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result = None
+        self.stages = None
+        # built at submission, released when the job finishes
+        self.pipeline = None
+
+    def to_dict(self):
+        info = {'id': self.id, 'kind': self.spec['kind'], 'status': self.status}
+        if self.started is not None:
+            info['queued_seconds'] = self.started - self.created
+        if self.finished is not None:
+            # cancelled jobs never started
+            if self.started is not None:
+                info['run_seconds'] = self.finished - self.started
+            info['latency'] = self.finished - self.created
+        if self.stages is not None:
+            info['stages'] = self.stages
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+
+class JobServer:
+    """Local HTTP server running style transfer and texture synthesis jobs
+
+    Jobs are queued and run by a bounded number of workers. Trained patch
+    providers are kept warm in a ProviderCache shared by all the jobs, so
+    jobs with a known style (or input texture) skip provider training.
+
+    Endpoints (JSON unless noted):
+        POST /jobs: Submit a job, returns its id
+        GET /jobs/<id>: Status, queueing time, latency and stage times
+        GET /jobs/<id>/result: Result as PNG
+        DELETE /jobs/<id>: Cancel a queued job
+        GET /stats: Queue depth, running and finished jobs, latencies and cache counters
+
+    A job is {'kind': 'transfer' or 'synthesis', 'images': {name: base64 encoded image},
+    'params': constructor arguments, 'search': {'name': ..., **args}, 'aggregate': {'name': ..., **args},
+    'weight': [{'name': ..., **args}, ...] (transfer only)}. 'search', 'aggregate' and 'weight' entries call
+    the search_by_*, aggregate_by_* and WeightMatBuilder.add_* methods. Images are 'content' and 'style'
+    for transfer, 'input' for synthesis.
+
+    Args:
+        n_workers (int, optional): Number of jobs run at the same time. Defaults to 1.
+        max_queue (int, optional): Number of queued jobs above which submissions are rejected. Defaults to 64.
+        provider_cache (ProviderCache, optional): Cache of trained providers. Defaults to a memory cache.
+        max_results (int, optional): Number of finished jobs kept. Defaults to 256.
+        memory_budget (int, optional): Planned peak memory (bytes) allowed per job. Jobs over it are fitted with
+            fit_memory_budget(), and fail when they can not be. Defaults to None (no limit).
+    """
+
+    def __init__(self, n_workers=1, max_queue=64, provider_cache=None, max_results=256, memory_budget=None):
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.provider_cache = provider_cache if provider_cache is not None else ProviderCache()
+        self.max_results = max_results
+        self.memory_budget = memory_budget
+        self.jobs = {}
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._finished = deque()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._ids = itertools.count(1)
+        self._queue = None
+        self._executor = None
+
+    async def serve(self, host='127.0.0.1', port=8000, path=None):
+        """Run the server until cancelled
+
+        Args:
+            host (str, optional): Host to listen on. Defaults to '127.0.0.1'.
+            port (int, optional): Port to listen on. Defaults to 8000.
+            path (str, optional): Unix socket to listen on instead of host and port
+        """
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(self.n_workers)
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.n_workers)]
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        latencies = np.array(self._latencies)
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+            'latency_mean': float(latencies.mean()) if len(latencies) else None,
+            'latency_p95': float(np.percentile(latencies, 95)) if len(latencies) else None,
+            'provider_cache': self.provider_cache.stats(),
+        }
+
+    def submit(self, spec):
+        """Queue a job
+
+        The pipeline is built here, so that malformed jobs are rejected before they are queued.
+
+        Args:
+            spec (dict): Job
+
+        Returns:
+            Job: Queued job
+
+        Raises:
+            JobError: 400 for a malformed job, 503 when the queue is full
+        """
+        if not isinstance(spec, dict):
+            raise JobError(400, 'A job must be a JSON object')
+        if spec.get('kind') not in ('transfer', 'synthesis'):
+            raise JobError(400, 'kind must be transfer or synthesis')
+        if self._queue.qsize() >= self.max_queue:
+            raise JobError(503, 'Queue is full')
+        try:
+            pipeline = self._build(spec)
+        except (TypeError, AttributeError, KeyError, ValueError) as e:
+            raise JobError(400, f'Invalid job: {type(e).__name__}: {e}')
+        job = Job(str(next(self._ids)), spec)
+        job.pipeline = pipeline
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def cancel(self, job):
+        """Cancel a queued job
+
+        Args:
+            job (Job): Job
+
+        Raises:
+            JobError: 409 when the job is already running or finished
+        """
+        if job.status != 'queued':
+            raise JobError(409, f'Job is {job.status}')
+        # the worker skips it when it is dequeued
+        job.status = 'cancelled'
+        job.pipeline = None
+        job.finished = time.time()
+        self.cancelled += 1
+        self._finish(job)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if job.status == 'cancelled':
+                continue
+            job.status = 'running'
+            job.started = time.time()
+            self.running += 1
+            try:
+                job.result, job.stages = await loop.run_in_executor(self._executor, self._run, job)
+                job.status = 'done'
+                self.completed += 1
+            except Exception as e:
+                job.status = 'failed'
+                job.error = f'{type(e).__name__}: {e}'
+                self.failed += 1
+            finally:
+                job.pipeline = None
+                self.running -= 1
+                job.finished = time.time()
+                self._latencies.append(job.finished - job.created)
+                self._finish(job)
+
+    def _finish(self, job):
+        self._finished.append(job.id)
+        while len(self._finished) > self.max_results:
+            del self.jobs[self._finished.popleft()]
+
+    def _build(self, spec):
+        """Pipeline of a job, with its search and aggregation set
+
+        Raises:
+            TypeError, AttributeError, KeyError, ValueError: Malformed job
+        """
+        images = {name: _decode_image(data) for name, data in spec.get('images', {}).items()}
+        params = _to_tuples(spec.get('params', {}))
+        if spec['kind'] == 'transfer':
+            if 'content' not in images:
+                raise ValueError('A transfer job needs a content image')
+            pipeline = StyleTransfer(images['content'], images['style'], **params)
+            if spec.get('weight'):
+                builder = WeightMatBuilder(images['content'], pipeline.dtype)
+                for step in spec['weight']:
+                    _call_builder(builder, 'add_', step)
+                pipeline.set_weight_mat(builder.get_mat())
+        else:
+            pipeline = TextureSynthesis(images['input'], **params)
+        _call_builder(pipeline, 'search_by_', spec['search'])
+        _call_builder(pipeline, 'aggregate_by_', spec['aggregate'])
+        return pipeline
+
+    def _run(self, job):
+        spec, pipeline = job.spec, job.pipeline
+        if self.memory_budget is not None:
+            pipeline.fit_memory_budget(self.memory_budget)
+        metrics = Metrics()
+        pipeline.use_provider_cache(self.provider_cache).use_metrics(metrics).show_progress(False)
+        result = pipeline.transfer() if spec['kind'] == 'transfer' else pipeline.synthesis()
+        stages = {name: entry['total'] for name, entry in metrics.summary().items() if entry['kind'] == 'time'}
+        return result, stages
+
+    async def _handle(self, reader, writer):
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            status, content_type, payload = self._route(method, target, body)
+        except JobError as e:
+            status, content_type, payload = e.status, 'application/json', json.dumps({'error': str(e)}).encode()
+        except (ValueError, KeyError, TypeError, AttributeError, asyncio.IncompleteReadError) as e:
+            status, content_type, payload = 400, 'application/json', json.dumps({'error': str(e)}).encode()
+        writer.write((
+            f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode('latin-1') + payload)
+        await writer.drain()
+        writer.close()
+
+    def _route(self, method, target, body):
+        parts = target.split('?')[0].strip('/').split('/')
+        if method == 'POST' and parts == ['jobs']:
+            job = self.submit(json.loads(body))
+            return 202, 'application/json', json.dumps(job.to_dict()).encode()
+        if method == 'GET' and parts == ['stats']:
+            return 200, 'application/json', json.dumps(self.stats()).encode()
+        if method == 'DELETE' and len(parts) == 2 and parts[0] == 'jobs':
+            job = self.jobs.get(parts[1])
+            if job is None:
+                raise JobError(404, f'Unknown job: {parts[1]}')
+            self.cancel(job)
+            return 200, 'application/json', json.dumps(job.to_dict()).encode()
+        if method == 'GET' and len(parts) in (2, 3) and parts[0] == 'jobs':
+            job = self.jobs.get(parts[1])
+            if job is None:
+                raise JobError(404, f'Unknown job: {parts[1]}')
+            if len(parts) == 2:
+                return 200, 'application/json', json.dumps(job.to_dict()).encode()
+            if parts[2] == 'result':
+                if job.status != 'done':
+                    raise JobError(409, f'Job is {job.status}')
+                return 200, 'image/png', cv2.imencode('.png', job.result)[1].tobytes()
+        raise JobError(404, f'Unknown endpoint: {method} {target}')
+
+
+def _decode_image(data):
+    try:
+        buffer = np.frombuffer(base64.b64decode(data, validate=True), dtype=np.uint8)
+        # imdecode asserts on an empty buffer
+        image = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if len(buffer) else None
+    except (binascii.Error, cv2.error) as e:
+        raise JobError(400, f'Can not decode the image: {e}')
+    if image is None:
+        raise JobError(400, 'Can not decode the image')
+    return image
+
+
+def _to_tuples(params):
+    # JSON has no tuples: patch sizes and the output size are lists
+    return {name: [tuple(v) for v in value] if name in ('patch_size_list', 'patch_spacing_list')
+            else tuple(value) if name == 'output_size' else value
+            for name, value in params.items()}
+
+
+def _call_builder(target, prefix, step):
+    """Call a builder method, e.g. search_by_HierarchicalNN, from {'name': 'HierarchicalNN', **args}
+    """
+    args = dict(step)
+    method = getattr(target, prefix + args.pop('name'), None)
+    if method is None:
+        raise ValueError(f"Unknown {prefix}{step['name']}")
+    method(**args)
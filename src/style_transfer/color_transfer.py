@@ -1,6 +1,8 @@
-import color_transfer
-import skimage.exposure
 import numpy as np
+from ..common.patch_aggregation import float_dtype
+
+# intensity levels of the lookup table
+LEVELS = 256
 
 
 def _preprocess(func):
@@ -15,9 +17,51 @@ def _preprocess(func):
 
 @_preprocess
 def lha_color_transfer(src, dst):
+    import color_transfer
     return color_transfer.color_transfer(src, dst)
 
 
 @_preprocess
 def histmatch_color_transfer(src, dst):
+    import skimage.exposure
     return skimage.exposure.match_histograms(dst, src, multichannel=True)
+
+
+class HistogramMatcher:
+    """Histogram matching to a fixed reference image
+
+    The cumulative histogram of each reference channel is computed once.
+    Images are matched through a lookup table per channel over the integer
+    levels 0-255, computed from the histogram of the image, and stay in
+    their floating point dtype (no uint8 round trip).
+
+    Args:
+        reference (ndarray): Image whose histogram is matched (H, W) or (H, W, C)
+    """
+
+    def __init__(self, reference):
+        channels = reference.reshape(reference.shape[:2] + (-1,))
+        self._cdfs = []
+        for c in range(channels.shape[2]):
+            values, counts = np.unique(channels[..., c], return_counts=True)
+            self._cdfs.append((values, np.cumsum(counts) / channels.shape[0] / channels.shape[1]))
+
+    def match(self, image):
+        """Match the histogram of an image to the reference
+
+        Args:
+            image (ndarray): Image with the channels of the reference
+
+        Returns:
+            ndarray: Matched image (in the floating point dtype of image, float64 for integer images)
+        """
+        channels = image.reshape(image.shape[:2] + (-1,))
+        if channels.shape[2] != len(self._cdfs):
+            raise ValueError('A number of channels must be same with the reference.')
+        result = np.empty(channels.shape, dtype=float_dtype(image.dtype))
+        for c, (values, cdf) in enumerate(self._cdfs):
+            levels = np.clip(channels[..., c], 0, LEVELS-1).astype(np.intp)
+            counts = np.bincount(levels.ravel(), minlength=LEVELS)
+            lut = np.interp(np.cumsum(counts) / levels.size, cdf, values).astype(result.dtype)
+            result[..., c] = lut[levels]
+        return result.reshape(image.shape)
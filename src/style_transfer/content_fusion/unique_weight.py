@@ -1,5 +1,5 @@
 import numpy as np
 
 
-def no_segmentation(image):
-    return np.ones(image.shape, dtype=np.float64)
+def no_segmentation(image, dtype=np.float64):
+    return np.ones(image.shape, dtype=dtype)
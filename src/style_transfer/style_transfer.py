@@ -1,27 +1,55 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import itertools
+import multiprocessing
+import os
+import time
 import numpy as np
 import cv2
-from .color_transfer import histmatch_color_transfer
+from .color_transfer import HistogramMatcher
 from ..common.pyramid import get_pyramid
-from ..common.patch_aggregation import extract_patches, l2_norm_aggregate, lp_norm_irls_aggregate
-from ..common.patch_aggregation.patch_provider import HierarchicalNN, FaissANN, NN
+from ..common.planner import fit_memory_budget, plan_stages, pyramid_shapes
+from ..common.checkpoint import Checkpoint
+from ..common.early_stopping import EarlyStopping
+from ..common.metrics import NullMetrics, record_aggregation
+from ..common.patch_aggregation import PatchGrid, PatchBank, MatchCache, AdaptiveSampling, create_provider, get_aggregator, provider_class
+from ..common.patch_aggregation.patch_provider import ParallelPatchProvider
 from .content_fusion import fuse_content
 from tqdm import tqdm
 
 
 class StyleTransfer:
-    def __init__(self, content_image, style_image, resolution_layer, patch_size_list, patch_spacing_list, iteration_n, init_noise_sigma=50):
+    def __init__(self, content_image, style_image, resolution_layer, patch_size_list, patch_spacing_list, iteration_n, init_noise_sigma=50, dtype=np.float64):
         if len(patch_size_list) != len(patch_spacing_list):
             raise ValueError('Invalid patch settings')
+        if np.ndim(iteration_n) != 0 and len(iteration_n) != resolution_layer:
+            raise ValueError('Invalid iteration settings')
         self.content_image = content_image
         self.style_image = style_image
         self.resolution_layer = resolution_layer
         self.patch_size_list = patch_size_list
         self.patch_spacing_list = patch_spacing_list
+        # int, or list of int (one per resolution layer)
         self.iteration_n = iteration_n
         self.init_noise_sigma = init_noise_sigma
-        self.weight_mat = np.zeros(content_image.shape, dtype=np.float64)
+        # np.float32 halves memory and bandwidth of the whole pipeline
+        self.dtype = np.dtype(dtype)
+        self.weight_mat = None if content_image is None else np.zeros(content_image.shape, dtype=np.float64)
         self.patch_aggregator = None
         self.patch_provider_builder = None
+        self.provider_cache = None
+        self.search_n_jobs = 1
+        self.search_backend = 'thread'
+        self.early_stopping_builder = None
+        self.match_cache_builder = None
+        # name and arguments of the aggregator, early stopping and match cache, hashed into the checkpoint key
+        self.run_settings = {}
+        self.sampling = None
+        self.metrics = NullMetrics()
+        self.progress = True
+        self.checkpoint = None
+        self.resume = False
+        self.patch_bank_dir = None
+        self.history = []
 
     def search_by_HierarchicalNN(self,  cluster_num, patch_amount_tol):
         """Search NN patches by hierarchical clustering
@@ -31,7 +59,7 @@ class StyleTransfer:
             patch_amount_tol (int): Number of patches allowed in a cluster
         """
         def wrapper():
-            return HierarchicalNN(cluster_num, patch_amount_tol)
+            return create_provider('HierarchicalNN', cluster_num, patch_amount_tol)
         self.patch_provider_builder = wrapper
         return self
 
@@ -39,7 +67,46 @@ class StyleTransfer:
         """Search NN patches by FAISS ANN
         """
         def wrapper():
-            return FaissANN()
+            return create_provider('FaissANN')
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_PCAANN(self, n_components=64, index_type='IVF', nlist=100, nprobe=8, hnsw_m=32, ef_search=64):
+        """Search NN patches by FAISS ANN on PCA-projected patches
+
+        Args:
+            n_components (int, optional): Number of principal components. Defaults to 64.
+            index_type (str, optional): 'IVF' or 'HNSW'. Defaults to 'IVF'.
+            nlist (int, optional): Number of inverted lists (IVF). Defaults to 100.
+            nprobe (int, optional): Number of inverted lists visited per query (IVF). Defaults to 8.
+            hnsw_m (int, optional): Number of neighbors per graph node (HNSW). Defaults to 32.
+            ef_search (int, optional): Size of the candidate list at search time (HNSW). Defaults to 64.
+        """
+        if index_type not in ('IVF', 'HNSW'):
+            raise ValueError(f'Unknown index type: {index_type}')
+
+        def wrapper():
+            return create_provider('PCAANN', n_components, index_type, nlist, nprobe, hnsw_m, ef_search)
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_PatchMatch(self, n_iteration=2, alpha=0.5):
+        """Search NN patches by PatchMatch, refining the nearest neighbor field across iterations and layers
+
+        Args:
+            n_iteration (int, optional): Propagation and random search rounds per aggregation. Defaults to 2.
+            alpha (float, optional): Shrink ratio of the random search radius. Defaults to 0.5.
+        """
+        def wrapper():
+            return create_provider('PatchMatch', n_iteration, alpha)
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_FFTNN(self):
+        """Search exact NN patches by FFT cross-correlation with the whole exemplar grid
+        """
+        def wrapper():
+            return create_provider('FFTNN')
         self.patch_provider_builder = wrapper
         return self
 
@@ -47,29 +114,177 @@ class StyleTransfer:
         """Search NN patches by simple NN (Not practical)
         """
         def wrapper():
-            return NN()
+            return create_provider('NN')
         self.patch_provider_builder = wrapper
         return self
 
     def aggregate_by_l2(self):
         """Aggregate by L2 optimization
         """
-        self.patch_aggregator = l2_norm_aggregate
+        self.patch_aggregator = get_aggregator('l2')
+        self.run_settings['aggregator'] = ('l2',)
         return self
 
-    def aggregate_by_lp_irls(self, irls_iteration=10, p_norm=1.2, irls_tol=0):
+    def aggregate_by_lp_irls(self, irls_iteration=10, p_norm=1.2, irls_tol=0, backend='numpy'):
         """Aggregate by IRLS optimization (LP norm linear regression)
 
         Args:
             irls_iteration (int, optional): Number of iteration for IRLS. Defaults to 10.
             p_norm (float, optional): p-norm. Defaults to 1.2.
             irls_tol (float, optional): Convergence condition for IRLS. Defaults to 0.
+            backend (str, optional): 'numpy' or 'numba' (fused kernel, falls back to 'numpy' without numba). Defaults to 'numpy'.
         """
-        def wrapper(img, provider, size, spacing):
-            return lp_norm_irls_aggregate(img, provider, size, spacing, irls_iteration, p_norm, irls_tol)
+        if backend not in ('numpy', 'numba'):
+            raise ValueError(f'Unknown backend: {backend}')
+
+        lp_irls = get_aggregator('lp_irls')
+
+        def wrapper(img, provider, size, spacing, stats=None, match_cache=None, mask=None):
+            return lp_irls(img, provider, size, spacing, irls_iteration, p_norm, irls_tol, stats, match_cache, backend, mask)
         self.patch_aggregator = wrapper
+        # the backend gives the same result
+        self.run_settings['aggregator'] = ('lp_irls', irls_iteration, p_norm, irls_tol)
+        return self
+
+    def stop_early(self, energy_tol=0, change_tol=0, min_iteration=1):
+        """Stop the iterations of a (resolution layer, patch size) stage when they converge
+
+        Args:
+            energy_tol (float, optional): Relative decrease of the patch matching energy. Defaults to 0 (disabled).
+            change_tol (float, optional): RMS image change. Defaults to 0 (disabled).
+            min_iteration (int, optional): Number of iterations always run in a stage. Defaults to 1.
+        """
+        def wrapper():
+            return EarlyStopping(energy_tol, change_tol, min_iteration)
+        self.early_stopping_builder = wrapper
+        self.run_settings['early_stopping'] = (energy_tol, change_tol, min_iteration)
+        return self
+
+    def requery_changed_only(self, threshold):
+        """Re-query only the target patches which changed since their last query
+
+        Args:
+            threshold (float): RMS change (pixel value) of a patch above which it is re-queried
+        """
+        def wrapper():
+            return MatchCache(threshold)
+        self.match_cache_builder = wrapper
+        self.run_settings['match_cache'] = (threshold,)
+        return self
+
+    def sample_adaptively(self, std_threshold=8, weight_threshold=None):
+        """Match every patch only in detailed regions, and a coarse sub-grid of patches in flat ones
+
+        Args:
+            std_threshold (float, optional): Standard deviation (pixel value) above which a patch is detailed. Defaults to 8.
+            weight_threshold (float, optional): Mean content weight above which a patch is detailed. Defaults to None (not used).
+        """
+        self.sampling = AdaptiveSampling(std_threshold, weight_threshold)
+        return self
+
+    def use_metrics(self, metrics):
+        """Record wall times and counts of the stages
+
+        Args:
+            metrics (Metrics): Receives the records, labeled with 'layer' and 'patch_size' where they apply
+        """
+        self.metrics = metrics
+        return self
+
+    def show_progress(self, enabled=True):
+        """Print the stages and show a progress bar of the iterations
+
+        Args:
+            enabled (bool, optional): Defaults to True.
+        """
+        self.progress = enabled
+        return self
+
+    def memory_map_patches(self, directory):
+        """Keep the exemplar patches of the providers in memory-mapped files
+
+        The patch matrices are written to directory and paged from disk, for
+        exemplars too large to hold all their patches in memory. Not applied
+        to providers loaded through a provider cache.
+
+        Args:
+            directory (str): Directory of the patch files
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.patch_bank_dir = directory
+        return self
+
+    def checkpoint_to(self, directory, resume=True):
+        """Save a checkpoint after each (resolution layer, patch size) stage of transfer()
+
+        Args:
+            directory (str): Directory of the checkpoints
+            resume (bool, optional): Continue from the last saved stage of the same run. Defaults to True.
+        """
+        self.checkpoint = Checkpoint(directory)
+        self.resume = resume
         return self
 
+    def _checkpoint_key(self, content_image, weight_mat):
+        patch_provider = self.patch_provider_builder()
+        return Checkpoint.make_key([content_image, self.style_image, weight_mat], (
+            self.resolution_layer, self.patch_size_list, self.patch_spacing_list, self.iteration_n,
+            self.init_noise_sigma, str(self.dtype), type(patch_provider).__name__, sorted(patch_provider.get_params().items()),
+            sorted(self.run_settings.items()),
+        ) + (() if self.sampling is None else (vars(self.sampling),)))
+
+    def _progress(self, iterable, message):
+        if not self.progress:
+            return iterable
+        print(message)
+        return tqdm(iterable)
+
+    def _iteration_budget(self, r_idx):
+        if np.ndim(self.iteration_n) == 0:
+            return self.iteration_n
+        return self.iteration_n[r_idx]
+
+    def use_provider_cache(self, provider_cache):
+        """Reuse trained patch providers through a cache
+
+        Args:
+            provider_cache (ProviderCache): Cache shared between runs
+        """
+        self.provider_cache = provider_cache
+        return self
+
+    def search_in_parallel(self, n_jobs, backend='thread'):
+        """Shard the patch search of each aggregation step across workers
+
+        Args:
+            n_jobs (int): Number of workers
+            backend (str, optional): 'thread' (FAISS based providers) or 'process' (HierarchicalNN, NN). Defaults to 'thread'.
+        """
+        if backend not in ('thread', 'process'):
+            raise ValueError(f'Unknown backend: {backend}')
+        self.search_n_jobs = n_jobs
+        self.search_backend = backend
+        return self
+
+    def _train_patch_provider(self, exemplar, patch_size, patch_spacing, labels):
+        if self.provider_cache is not None:
+            with self.metrics.timer('provider_training', **labels):
+                patch_provider = self.provider_cache.get_provider(self.patch_provider_builder, exemplar, patch_size, patch_spacing)
+        else:
+            with self.metrics.timer('patch_extraction', **labels):
+                patches = PatchGrid(exemplar, patch_size, patch_spacing)
+                if self.patch_bank_dir is not None:
+                    # exemplars of other runs sharing the directory get their own files
+                    filename = 'layer{}_patch{}x{}_spacing{}x{}_{}.npy'.format(
+                        labels['layer'], *patch_size, *patch_spacing, Checkpoint.make_key([exemplar], ())[:16])
+                    patches = PatchBank.from_patches(patches, path=os.path.join(self.patch_bank_dir, filename))
+            with self.metrics.timer('provider_training', **labels):
+                patch_provider = self.patch_provider_builder()
+                patch_provider.train(patches)
+        if self.search_n_jobs > 1:
+            patch_provider = ParallelPatchProvider(patch_provider, self.search_n_jobs, self.search_backend)
+        return patch_provider
+
     def set_weight_mat(self, weight_mat):
         if self.content_image.shape != weight_mat.shape:
             raise ValueError(
@@ -77,36 +292,278 @@ class StyleTransfer:
         self.weight_mat = weight_mat
         return self
 
-    def transfer(self):
+    def _check_settings(self):
         if not self.patch_aggregator:
             raise ValueError('Call aggregare_by_* method before trasnfer()')
         if not self.patch_provider_builder:
             raise ValueError('Call search_by_* method before transfer()')
 
-        color_transfered = histmatch_color_transfer(self.style_image, self.content_image)
-        color_transfered = color_transfered.astype(np.float64)
-        style_image = self.style_image.astype(np.float64)
+    def plan(self):
+        """Estimate the patch counts, memory and query cost of each stage before running
+
+        Returns:
+            dict: See planner.plan_stages
+        """
+        self._check_settings()
+        patch_provider = self.patch_provider_builder()
+        return plan_stages(
+            self._plan_stages(self.patch_spacing_list), type(patch_provider).__name__, patch_provider.get_params(),
+            self.dtype.itemsize, self.patch_bank_dir is not None)
+
+    def fit_memory_budget(self, memory_budget, providers=('PatchMatch',)):
+        """Coarsen the patch spacings or switch the provider so that the planned peak memory fits in a budget
+
+        Nothing changes when the current settings fit. Otherwise the provider
+        needing the fewest spacing doublings is used.
+
+        Args:
+            memory_budget (int): Peak memory allowed (bytes)
+            providers (tuple of str, optional): Providers (with their default settings) which may replace the current one. Defaults to ('PatchMatch',).
+        """
+        self._check_settings()
+        patch_provider = self.patch_provider_builder()
+        candidates = [(type(patch_provider).__name__, patch_provider.get_params())]
+        candidates += [(name, provider_class(name)().get_params()) for name in providers if name != candidates[0][0]]
+        fitted = fit_memory_budget(
+            self._plan_stages, self.patch_size_list, self.patch_spacing_list, candidates, memory_budget,
+            self.dtype.itemsize, self.patch_bank_dir is not None)
+        if fitted is None:
+            raise ValueError(f'No patch spacing or provider fits in {memory_budget} bytes')
+        (name, params), patch_spacing_list, _ = fitted
+        self.patch_spacing_list = patch_spacing_list
+        if name != candidates[0][0]:
+            def wrapper():
+                return create_provider(name, **params)
+            self.patch_provider_builder = wrapper
+        return self
+
+    def _plan_stages(self, patch_spacing_list):
+        style_shapes = pyramid_shapes(self.style_image.shape, self.resolution_layer)
+        content_shapes = pyramid_shapes(self.content_image.shape, self.resolution_layer)
+        return [
+            {
+                'layer': r_idx, 'setting': p_idx, 'patch_size': patch_size, 'patch_spacing': patch_spacing,
+                'exemplar_shape': style_shapes[r_idx], 'target_shape': content_shapes[r_idx], 'iteration': self._iteration_budget(r_idx),
+            }
+            for r_idx in range(self.resolution_layer)
+            for p_idx, (patch_size, patch_spacing) in enumerate(zip(self.patch_size_list, patch_spacing_list))
+        ]
+
+    def _prepare_style(self):
+        """Prepare everything that depends only on the style image
+
+        Returns:
+            dict: Style pyramid, histogram matchers of the style image and of each layer,
+                and trained patch providers keyed by (layer index, patch setting index)
+        """
+        style_image = self.style_image.astype(self.dtype)
+        with self.metrics.timer('pyramid', image='style'):
+            style_pyramid = get_pyramid(style_image, self.resolution_layer)
+        patch_providers = {}
+        for r_idx in range(self.resolution_layer):
+            for p_idx, (patch_size, patch_spacing) in enumerate(zip(self.patch_size_list, self.patch_spacing_list)):
+                patch_providers[(r_idx, p_idx)] = self._train_patch_provider(
+                    style_pyramid[r_idx], patch_size, patch_spacing, {'layer': r_idx, 'patch_size': patch_size})
+        return {
+            'style_pyramid': style_pyramid,
+            'style_matcher': HistogramMatcher(self.style_image),
+            'layer_matchers': [HistogramMatcher(layer) for layer in style_pyramid],
+            'patch_providers': patch_providers,
+        }
+
+    def transfer(self):
+        self._check_settings()
+        if self.content_image is None:
+            raise ValueError('Content image is not set')
+        return self._transfer(self.content_image, self.weight_mat, self._prepare_style(), self.checkpoint)
+
+    def transfer_many(self, content_images, weight_mat_builder=None, n_jobs=1):
+        """Transfer the style to many content images
+
+        The style side (pyramid and trained patch providers) is prepared once
+        and shared by all the transfers. Each content image draws its random
+        choices from its own generator, seeded from the global np.random
+        state and its index, so the results do not depend on n_jobs.
+
+        With n_jobs > 1 the transfers run in worker processes forked after
+        the style is prepared, so the trained providers are shared instead
+        of pickled. Where fork is not available (Windows, macOS spawn
+        default) they run in threads instead.
+
+        Args:
+            content_images (iterable of ndarray): Content images
+            weight_mat_builder (callable, optional): Returns the weight mat of a content image. Defaults to zero weights.
+            n_jobs (int, optional): Number of worker processes (forked). Defaults to 1.
+
+        Returns:
+            generator of ndarray: Results in the order of content_images
+        """
+        self._check_settings()
+        style = self._prepare_style()
+        entropy = np.random.randint(2**31)
+
+        def transfer_one(content_image, idx):
+            rng = np.random.default_rng([entropy, idx])
+            return self._transfer(content_image, self._weight_mat_of(content_image, weight_mat_builder), style, rng=rng)
+
+        def sequential():
+            for idx, content_image in enumerate(content_images):
+                yield transfer_one(content_image, idx)
+
+        if n_jobs == 1:
+            return sequential()
+        return _transfer_in_pool(transfer_one, content_images, n_jobs)
+
+    def transfer_video(self, frames, weight_mat_builder=None, warm_layers=1, warm_iteration_n=1):
+        """Transfer the style to a sequence of frames, yielding each frame as soon as it is done
+
+        The style side is prepared once. The first frame (and any frame of a
+        new shape) is transferred like a still image. The other frames start
+        from the previous result, shifted by the change of the color
+        transferred content, and run only the warm_layers finest resolution
+        layers for warm_iteration_n iterations. Each stage continues the
+        search of the same stage of the previous frame (PatchMatch fields and
+        the matches kept by requery_changed_only()).
+
+        Args:
+            frames (iterable of ndarray): Frames, consumed lazily
+            weight_mat_builder (callable, optional): Returns the weight mat of a frame. Defaults to zero weights.
+            warm_layers (int, optional): Number of finest resolution layers run on warm started frames. Defaults to 1.
+            warm_iteration_n (int, optional): Number of iterations of each stage of warm started frames. Defaults to 1.
+
+        Returns:
+            generator of ndarray: Stylized frames in the order of frames
+        """
+        if not 1 <= warm_layers <= self.resolution_layer:
+            raise ValueError('warm_layers must be between 1 and resolution_layer')
+        self._check_settings()
+        style = self._prepare_style()
+        video = {
+            'warm_layers': warm_layers,
+            'iteration_n': warm_iteration_n,
+            'image': None,
+            'color_transfered': None,
+            'providers': {},
+            'match_caches': {},
+        }
+
+        def sequential():
+            for frame in frames:
+                yield self._transfer(frame, self._weight_mat_of(frame, weight_mat_builder), style, video=video)
+        return sequential()
+
+    def _weight_mat_of(self, content_image, weight_mat_builder):
+        if weight_mat_builder is None:
+            return np.zeros(content_image.shape, dtype=self.dtype)
+        weight_mat = weight_mat_builder(content_image)
+        if content_image.shape != weight_mat.shape:
+            raise ValueError(
+                'A shape of the weight mat must be same with the content image.')
+        return weight_mat
+
+    def _transfer(self, content_image, weight_mat, style, checkpoint=None, video=None, rng=None):
+        """Transfer the style to a content image
+
+        Args:
+            content_image (ndarray): Content image
+            weight_mat (ndarray): Weight mat of the content image
+            style (dict): Result of _prepare_style
+            checkpoint (Checkpoint, optional): Saves each stage, and resumes the run when self.resume is set
+            video (dict, optional): State carried between the frames of transfer_video, updated in place
+            rng (np.random.Generator, optional): Generator of the random choices. Defaults to the global generators.
+
+        Returns:
+            ndarray: Result
+        """
+        self.history = []
+        metrics = self.metrics
+        layer_matchers = style['layer_matchers']
+        with metrics.timer('color_transfer'):
+            color_transfered = style['style_matcher'].match(content_image)
+        color_transfered = color_transfered.astype(self.dtype)
 
         # prepare pyramid
-        style_pyramid = get_pyramid(style_image, self.resolution_layer)
-        color_transfered_pyramid = get_pyramid(color_transfered, self.resolution_layer)
-        weight_mat_pyramid = get_pyramid(self.weight_mat, self.resolution_layer)
+        with metrics.timer('pyramid', image='content'):
+            color_transfered_pyramid = get_pyramid(color_transfered, self.resolution_layer)
+            weight_mat_pyramid = get_pyramid(weight_mat.astype(self.dtype, copy=False), self.resolution_layer)
 
         # initialize
-        output_image = color_transfered_pyramid[0]+np.random.normal(
-            scale=self.init_noise_sigma, size=color_transfered_pyramid[0].shape)
+        warm = video is not None and video['image'] is not None and video['image'].shape == color_transfered.shape
+        start_layer = self.resolution_layer - video['warm_layers'] if warm else 0
+        if warm:
+            # previous frame moved by the change of the content
+            warm_image = video['image']
+            if start_layer < self.resolution_layer-1:
+                warm_image = get_pyramid(warm_image, self.resolution_layer)[start_layer]
+            output_image = warm_image + (color_transfered_pyramid[start_layer] - video['color_transfered'][start_layer])
+        else:
+            normal = np.random.normal if rng is None else rng.normal
+            output_image = color_transfered_pyramid[0]+normal(
+                scale=self.init_noise_sigma, size=color_transfered_pyramid[0].shape).astype(self.dtype)
+
+        resumed = None
+        if checkpoint is not None:
+            key = self._checkpoint_key(content_image, weight_mat)
+            resumed = checkpoint.load(key) if self.resume else None
+            if resumed is None:
+                checkpoint.clear()
+            else:
+                output_image = resumed['image']
+                self.history = resumed['history']
 
         # style_transfer
-        for r_idx in range(self.resolution_layer):
-            for patch_size, patch_spacing in zip(self.patch_size_list, self.patch_spacing_list):
-                style_patches = extract_patches(style_pyramid[r_idx], patch_size, patch_spacing)
-                patch_provider = self.patch_provider_builder()
-                patch_provider.train(style_patches)
-                print(f'Layer: {output_image.shape}, Patch: {patch_size}')
-                for _ in tqdm(range(self.iteration_n)):
-                    output_image = self.patch_aggregator(output_image, patch_provider, patch_size, patch_spacing)
-                    output_image = fuse_content(output_image, color_transfered_pyramid[r_idx], weight_mat_pyramid[r_idx])
-                    output_image = histmatch_color_transfer(style_pyramid[r_idx], output_image)
+        match_cache = self.match_cache_builder() if self.match_cache_builder else None
+        previous_provider, previous_layer = None, 0
+        if resumed is not None:
+            # the next stage warm-starts from the search state of the resumed one
+            previous_layer = resumed['stage'][0]
+            previous_provider = style['patch_providers'][resumed['stage']].warm_started(None)
+            previous_provider.set_search_state(resumed['provider_state'])
+        for r_idx in range(start_layer, self.resolution_layer):
+            # the resumed image is already at the resolution of its layer
+            if resumed is not None and r_idx < resumed['stage'][0]:
+                continue
+            for p_idx, (patch_size, patch_spacing) in enumerate(zip(self.patch_size_list, self.patch_spacing_list)):
+                if resumed is not None and (r_idx, p_idx) <= resumed['stage']:
+                    continue
+                if warm:
+                    # continue the search of the same stage of the previous frame
+                    patch_provider = style['patch_providers'][(r_idx, p_idx)].warm_started(video['providers'].get((r_idx, p_idx)))
+                else:
+                    patch_provider = style['patch_providers'][(r_idx, p_idx)].warm_started(previous_provider, 2**(r_idx-previous_layer))
+                if rng is not None:
+                    patch_provider = patch_provider.seeded(rng)
+                previous_provider, previous_layer = patch_provider, r_idx
+                if video is not None:
+                    video['providers'][(r_idx, p_idx)] = patch_provider
+                    if self.match_cache_builder:
+                        match_cache = video['match_caches'].setdefault((r_idx, p_idx), self.match_cache_builder())
+                early_stopping = self.early_stopping_builder() if self.early_stopping_builder else None
+                labels = {'layer': r_idx, 'patch_size': patch_size}
+                mask = None
+                if self.sampling is not None:
+                    # the detail of the content does not change over the iterations
+                    mask = self.sampling.mask(color_transfered_pyramid[r_idx], patch_size, patch_spacing, weight_mat_pyramid[r_idx])
+                iteration_n = video['iteration_n'] if warm else self._iteration_budget(r_idx)
+                for itr in self._progress(range(iteration_n), f'Layer: {output_image.shape}, Patch: {patch_size}'):
+                    stats = {}
+                    previous_image = output_image
+                    start = time.perf_counter()
+                    output_image = self.patch_aggregator(output_image, patch_provider, patch_size, patch_spacing, stats=stats, match_cache=match_cache, mask=mask)
+                    record_aggregation(metrics, time.perf_counter() - start, stats, labels)
+                    with metrics.timer('content_fusion', **labels):
+                        output_image = fuse_content(output_image, color_transfered_pyramid[r_idx], weight_mat_pyramid[r_idx])
+                    with metrics.timer('color_transfer', **labels):
+                        output_image = layer_matchers[r_idx].match(output_image)
+                    change = float(np.sqrt(np.mean(np.square(output_image - previous_image))))
+                    self.history.append({
+                        'layer': r_idx, 'patch_size': patch_size, 'iteration': itr,
+                        'energy': stats['energy'], 'queried': stats['queried'], 'change': change,
+                    })
+                    if early_stopping and early_stopping.update(stats['energy'], change):
+                        break
+                if checkpoint is not None:
+                    checkpoint.save(key, (r_idx, p_idx), output_image, self.history, patch_provider.get_search_state())
 
             if r_idx < self.resolution_layer-1:
                 output_image = cv2.pyrUp(output_image)
@@ -116,4 +573,33 @@ class StyleTransfer:
                 if output_image.shape[1] > color_transfered_pyramid[r_idx+1].shape[1]:
                     output_image = output_image[:, :color_transfered_pyramid[r_idx+1].shape[1]]
 
+        if video is not None:
+            video['image'] = output_image
+            video['color_transfered'] = color_transfered_pyramid
         return output_image.astype(np.uint8)
+
+
+# transfer of one (content image, index), with the prepared style, inherited by forked workers
+_shared_transfer = None
+
+
+def _transfer_worker(content_image, idx):
+    return _shared_transfer(content_image, idx)
+
+
+def _transfer_in_pool(transfer_one, content_images, n_jobs):
+    """Run transfers in worker processes sharing the prepared style
+
+    Workers are forked after the style is prepared, so trained providers
+    (including FAISS indices which can not be pickled) are shared read-only
+    instead of being sent to each worker. Threads are used where fork is
+    not available; the heavy parts (FAISS, numpy, OpenCV) release the GIL.
+    """
+    global _shared_transfer
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        with ThreadPoolExecutor(n_jobs) as executor:
+            yield from executor.map(transfer_one, content_images, itertools.count())
+        return
+    _shared_transfer = transfer_one
+    with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('fork')) as executor:
+        yield from executor.map(_transfer_worker, content_images, itertools.count())
@@ -4,12 +4,12 @@ from .content_fusion import no_segmentation, laplacian_edge_weight, sobel_edge_w
 
 
 class WeightMatBuilder:
-    def __init__(self, content_image):
+    def __init__(self, content_image, dtype=np.float64):
         self.content_image = content_image.copy()
-        self.weight_mat = np.zeros(content_image.shape, dtype=np.float64)
+        self.weight_mat = np.zeros(content_image.shape, dtype=dtype)
 
     def add_identity(self, weight=1.0):
-        self.weight_mat[:] += weight*no_segmentation(self.content_image)
+        self.weight_mat[:] += weight*no_segmentation(self.content_image, self.weight_mat.dtype)
         return self
 
     def add_laplacian_edge(self, dilation_n=0, dilation_kernel=(3, 3), weight=1.0):
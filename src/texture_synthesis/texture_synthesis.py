@@ -1,13 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
 import numpy as np
 import cv2
 from ..common.pyramid import get_pyramid
-from ..common.patch_aggregation import extract_patches, l2_norm_aggregate, lp_norm_irls_aggregate
-from ..common.patch_aggregation.patch_provider import RandomPick, HierarchicalNN, FaissANN, NN
+from ..common.planner import fit_memory_budget, plan_stages, pyramid_shapes
+from ..common.checkpoint import Checkpoint
+from ..common.early_stopping import EarlyStopping
+from ..common.metrics import NullMetrics, record_aggregation
+from ..common.patch_aggregation import PatchGrid, PatchBank, MatchCache, AdaptiveSampling, create_provider, get_aggregator, provider_class
+from ..common.patch_aggregation.patch_provider import ParallelPatchProvider
 from tqdm import tqdm
 
 
 class TextureSynthesis:
-    def __init__(self, input_image, output_size, resolution_layer, patch_size_list, patch_spacing_list, iteration_n):
+    def __init__(self, input_image, output_size, resolution_layer, patch_size_list, patch_spacing_list, iteration_n, dtype=np.float64):
         """Texture synthesis
 
         Args:
@@ -16,18 +23,36 @@ class TextureSynthesis:
             resolution_layer (int): Number of resolution layer
             patch_size_list (tuple): List of patch sizes
             patch_spacing_list (tuple): List of patch sampling gaps
-            iteration_n (int): Number of iteration
+            iteration_n (int or list of int): Number of iteration (per resolution layer)
+            dtype (dtype, optional): Floating point dtype of the whole pipeline. np.float32 halves memory and bandwidth. Defaults to np.float64.
         """
         if resolution_layer != len(patch_size_list) or resolution_layer != len(patch_spacing_list):
             raise ValueError('Invalid patch settings')
+        if np.ndim(iteration_n) != 0 and len(iteration_n) != resolution_layer:
+            raise ValueError('Invalid iteration settings')
         self.input_image = input_image
         self.output_size = output_size
         self.resolution_layer = resolution_layer
         self.patch_size_list = patch_size_list
         self.patch_spacing_list = patch_spacing_list
         self.iteration_n = iteration_n
+        self.dtype = np.dtype(dtype)
         self.patch_aggregator = None
         self.patch_provider_builder = None
+        self.provider_cache = None
+        self.search_n_jobs = 1
+        self.search_backend = 'thread'
+        self.early_stopping_builder = None
+        self.match_cache_builder = None
+        # name and arguments of the aggregator, early stopping and match cache, hashed into the checkpoint key
+        self.run_settings = {}
+        self.sampling = None
+        self.metrics = NullMetrics()
+        self.progress = True
+        self.checkpoint = None
+        self.resume = False
+        self.patch_bank_dir = None
+        self.history = []
 
     def search_by_HierarchicalNN(self,  cluster_num, patch_amount_tol):
         """Search NN patches by hierarchical clustering
@@ -37,7 +62,7 @@ class TextureSynthesis:
             patch_amount_tol (int): Number of patches allowed in a cluster
         """
         def wrapper():
-            return HierarchicalNN(cluster_num, patch_amount_tol)
+            return create_provider('HierarchicalNN', cluster_num, patch_amount_tol)
         self.patch_provider_builder = wrapper
         return self
 
@@ -45,7 +70,46 @@ class TextureSynthesis:
         """Search NN patches by FAISS ANN
         """
         def wrapper():
-            return FaissANN()
+            return create_provider('FaissANN')
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_PCAANN(self, n_components=64, index_type='IVF', nlist=100, nprobe=8, hnsw_m=32, ef_search=64):
+        """Search NN patches by FAISS ANN on PCA-projected patches
+
+        Args:
+            n_components (int, optional): Number of principal components. Defaults to 64.
+            index_type (str, optional): 'IVF' or 'HNSW'. Defaults to 'IVF'.
+            nlist (int, optional): Number of inverted lists (IVF). Defaults to 100.
+            nprobe (int, optional): Number of inverted lists visited per query (IVF). Defaults to 8.
+            hnsw_m (int, optional): Number of neighbors per graph node (HNSW). Defaults to 32.
+            ef_search (int, optional): Size of the candidate list at search time (HNSW). Defaults to 64.
+        """
+        if index_type not in ('IVF', 'HNSW'):
+            raise ValueError(f'Unknown index type: {index_type}')
+
+        def wrapper():
+            return create_provider('PCAANN', n_components, index_type, nlist, nprobe, hnsw_m, ef_search)
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_PatchMatch(self, n_iteration=2, alpha=0.5):
+        """Search NN patches by PatchMatch, refining the nearest neighbor field across iterations and layers
+
+        Args:
+            n_iteration (int, optional): Propagation and random search rounds per aggregation. Defaults to 2.
+            alpha (float, optional): Shrink ratio of the random search radius. Defaults to 0.5.
+        """
+        def wrapper():
+            return create_provider('PatchMatch', n_iteration, alpha)
+        self.patch_provider_builder = wrapper
+        return self
+
+    def search_by_FFTNN(self):
+        """Search exact NN patches by FFT cross-correlation with the whole exemplar grid
+        """
+        def wrapper():
+            return create_provider('FFTNN')
         self.patch_provider_builder = wrapper
         return self
 
@@ -53,64 +117,455 @@ class TextureSynthesis:
         """Search NN patches by simple NN (Not practical)
         """
         def wrapper():
-            return NN()
+            return create_provider('NN')
         self.patch_provider_builder = wrapper
         return self
 
     def aggregate_by_l2(self):
         """Aggregate by L2 optimization
         """
-        self.patch_aggregator = l2_norm_aggregate
+        self.patch_aggregator = get_aggregator('l2')
+        self.run_settings['aggregator'] = ('l2',)
         return self
 
-    def aggregate_by_lp_irls(self, irls_iteration=10, p_norm=1.2, irls_tol=0):
+    def aggregate_by_lp_irls(self, irls_iteration=10, p_norm=1.2, irls_tol=0, backend='numpy'):
         """Aggregate by IRLS optimization (LP norm linear regression)
 
         Args:
             irls_iteration (int, optional): Number of iteration for IRLS. Defaults to 10.
             p_norm (float, optional): p-norm. Defaults to 1.2.
             irls_tol (float, optional): Convergence condition for IRLS. Defaults to 0.
+            backend (str, optional): 'numpy' or 'numba' (fused kernel, falls back to 'numpy' without numba). Defaults to 'numpy'.
         """
-        def wrapper(img, provider, size, spacing):
-            return lp_norm_irls_aggregate(img, provider, size, spacing, irls_iteration, p_norm, irls_tol)
+        if backend not in ('numpy', 'numba'):
+            raise ValueError(f'Unknown backend: {backend}')
+
+        lp_irls = get_aggregator('lp_irls')
+
+        def wrapper(img, provider, size, spacing, stats=None, match_cache=None, mask=None):
+            return lp_irls(img, provider, size, spacing, irls_iteration, p_norm, irls_tol, stats, match_cache, backend, mask)
         self.patch_aggregator = wrapper
+        # the backend gives the same result
+        self.run_settings['aggregator'] = ('lp_irls', irls_iteration, p_norm, irls_tol)
         return self
 
-    def synthesis(self):
+    def stop_early(self, energy_tol=0, change_tol=0, min_iteration=1):
+        """Stop the iterations of a (resolution layer, patch size) stage when they converge
+
+        Args:
+            energy_tol (float, optional): Relative decrease of the patch matching energy. Defaults to 0 (disabled).
+            change_tol (float, optional): RMS image change. Defaults to 0 (disabled).
+            min_iteration (int, optional): Number of iterations always run in a stage. Defaults to 1.
+        """
+        def wrapper():
+            return EarlyStopping(energy_tol, change_tol, min_iteration)
+        self.early_stopping_builder = wrapper
+        self.run_settings['early_stopping'] = (energy_tol, change_tol, min_iteration)
+        return self
+
+    def requery_changed_only(self, threshold):
+        """Re-query only the target patches which changed since their last query
+
+        Args:
+            threshold (float): RMS change (pixel value) of a patch above which it is re-queried
+        """
+        def wrapper():
+            return MatchCache(threshold)
+        self.match_cache_builder = wrapper
+        self.run_settings['match_cache'] = (threshold,)
+        return self
+
+    def sample_adaptively(self, std_threshold=8):
+        """Match every patch only in detailed regions, and a coarse sub-grid of patches in flat ones
+
+        Args:
+            std_threshold (float, optional): Standard deviation (pixel value) above which a patch is detailed. Defaults to 8.
+        """
+        self.sampling = AdaptiveSampling(std_threshold)
+        return self
+
+    def use_metrics(self, metrics):
+        """Record wall times and counts of the stages
+
+        Args:
+            metrics (Metrics): Receives the records, labeled with 'layer' and 'patch_size' where they apply
+        """
+        self.metrics = metrics
+        return self
+
+    def show_progress(self, enabled=True):
+        """Print the stages and show a progress bar of the iterations
+
+        Args:
+            enabled (bool, optional): Defaults to True.
+        """
+        self.progress = enabled
+        return self
+
+    def memory_map_patches(self, directory):
+        """Keep the exemplar patches of the providers in memory-mapped files
+
+        The patch matrices are written to directory and paged from disk, for
+        exemplars too large to hold all their patches in memory. Not applied
+        to providers loaded through a provider cache.
+
+        Args:
+            directory (str): Directory of the patch files
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.patch_bank_dir = directory
+        return self
+
+    def checkpoint_to(self, directory, resume=True):
+        """Save a checkpoint after each (resolution layer, patch size) stage of synthesis()
+
+        Args:
+            directory (str): Directory of the checkpoints
+            resume (bool, optional): Continue from the last saved stage of the same run. Defaults to True.
+        """
+        self.checkpoint = Checkpoint(directory)
+        self.resume = resume
+        return self
+
+    def _checkpoint_key(self):
+        patch_provider = self.patch_provider_builder()
+        return Checkpoint.make_key([self.input_image], (
+            self.output_size, self.resolution_layer, self.patch_size_list, self.patch_spacing_list, self.iteration_n,
+            str(self.dtype), type(patch_provider).__name__, sorted(patch_provider.get_params().items()),
+            sorted(self.run_settings.items()),
+        ) + (() if self.sampling is None else (vars(self.sampling),)))
+
+    def _progress(self, iterable, message):
+        if not self.progress:
+            return iterable
+        print(message)
+        return tqdm(iterable)
+
+    def _iteration_budget(self, r_idx):
+        if np.ndim(self.iteration_n) == 0:
+            return self.iteration_n
+        return self.iteration_n[r_idx]
+
+    def use_provider_cache(self, provider_cache):
+        """Reuse trained patch providers through a cache
+
+        Args:
+            provider_cache (ProviderCache): Cache shared between runs
+        """
+        self.provider_cache = provider_cache
+        return self
+
+    def search_in_parallel(self, n_jobs, backend='thread'):
+        """Shard the patch search of each aggregation step across workers
+
+        Args:
+            n_jobs (int): Number of workers
+            backend (str, optional): 'thread' (FAISS based providers) or 'process' (HierarchicalNN, NN). Defaults to 'thread'.
+        """
+        if backend not in ('thread', 'process'):
+            raise ValueError(f'Unknown backend: {backend}')
+        self.search_n_jobs = n_jobs
+        self.search_backend = backend
+        return self
+
+    def _train_patch_provider(self, exemplar, patch_size, patch_spacing, labels):
+        if self.provider_cache is not None:
+            with self.metrics.timer('provider_training', **labels):
+                patch_provider = self.provider_cache.get_provider(self.patch_provider_builder, exemplar, patch_size, patch_spacing)
+        else:
+            with self.metrics.timer('patch_extraction', **labels):
+                patches = PatchGrid(exemplar, patch_size, patch_spacing)
+                if self.patch_bank_dir is not None:
+                    # exemplars of other runs sharing the directory get their own files
+                    filename = 'layer{}_patch{}x{}_spacing{}x{}_{}.npy'.format(
+                        labels['layer'], *patch_size, *patch_spacing, Checkpoint.make_key([exemplar], ())[:16])
+                    patches = PatchBank.from_patches(patches, path=os.path.join(self.patch_bank_dir, filename))
+            with self.metrics.timer('provider_training', **labels):
+                patch_provider = self.patch_provider_builder()
+                patch_provider.train(patches)
+        if self.search_n_jobs > 1:
+            patch_provider = ParallelPatchProvider(patch_provider, self.search_n_jobs, self.search_backend)
+        return patch_provider
+
+    def _check_settings(self):
         if not self.patch_aggregator:
             raise ValueError('Patch aggregator is not set')
         if not self.patch_provider_builder:
             raise ValueError('Patch provider is not set')
-        # prepare pyramid
-        input_pyramid = get_pyramid(self.input_image, self.resolution_layer)
 
-        # initialze
-        output_shape = list(self.output_size)
+    def _output_shape(self, size):
+        output_shape = list(size)
         if len(self.input_image.shape) == 3:
             output_shape.append(self.input_image.shape[2])
-        output_texture = get_pyramid(np.zeros(output_shape, dtype=np.float64), self.resolution_layer)[0]
-        input_patches_for_init = extract_patches(input_pyramid[0], self.patch_size_list[-1], self.patch_spacing_list[-1])
-        rp = RandomPick()
+        return tuple(output_shape)
+
+    def plan(self):
+        """Estimate the patch counts, memory and query cost of each stage before running
+
+        Returns:
+            dict: See planner.plan_stages
+        """
+        self._check_settings()
+        patch_provider = self.patch_provider_builder()
+        return plan_stages(
+            self._plan_stages(self.patch_spacing_list), type(patch_provider).__name__, patch_provider.get_params(),
+            self.dtype.itemsize, self.patch_bank_dir is not None)
+
+    def fit_memory_budget(self, memory_budget, providers=('PatchMatch',)):
+        """Coarsen the patch spacings or switch the provider so that the planned peak memory fits in a budget
+
+        Nothing changes when the current settings fit. Otherwise the provider
+        needing the fewest spacing doublings is used.
+
+        Args:
+            memory_budget (int): Peak memory allowed (bytes)
+            providers (tuple of str, optional): Providers (with their default settings) which may replace the current one. Defaults to ('PatchMatch',).
+        """
+        self._check_settings()
+        patch_provider = self.patch_provider_builder()
+        candidates = [(type(patch_provider).__name__, patch_provider.get_params())]
+        candidates += [(name, provider_class(name)().get_params()) for name in providers if name != candidates[0][0]]
+        fitted = fit_memory_budget(
+            self._plan_stages, self.patch_size_list, self.patch_spacing_list, candidates, memory_budget,
+            self.dtype.itemsize, self.patch_bank_dir is not None)
+        if fitted is None:
+            raise ValueError(f'No patch spacing or provider fits in {memory_budget} bytes')
+        (name, params), patch_spacing_list, _ = fitted
+        self.patch_spacing_list = patch_spacing_list
+        if name != candidates[0][0]:
+            def wrapper():
+                return create_provider(name, **params)
+            self.patch_provider_builder = wrapper
+        return self
+
+    def _plan_stages(self, patch_spacing_list):
+        input_shapes = pyramid_shapes(self.input_image.shape, self.resolution_layer)
+        output_shapes = pyramid_shapes(self._output_shape(self.output_size), self.resolution_layer)
+        return [
+            {
+                'layer': r_idx, 'setting': p_idx, 'patch_size': self.patch_size_list[p_idx], 'patch_spacing': patch_spacing_list[p_idx],
+                'exemplar_shape': input_shapes[r_idx], 'target_shape': output_shapes[r_idx], 'iteration': self._iteration_budget(r_idx),
+            }
+            for r_idx in range(self.resolution_layer)
+            for p_idx in range(self.resolution_layer-1-r_idx, self.resolution_layer)
+        ]
+
+    def _prepare_input(self):
+        """Prepare everything that depends only on the input image
+
+        Returns:
+            dict: Input pyramid and trained patch providers keyed by (layer index, patch setting index)
+        """
+        # providers work in the pipeline dtype
+        with self.metrics.timer('pyramid', image='input'):
+            input_pyramid = [layer.astype(self.dtype) for layer in get_pyramid(self.input_image, self.resolution_layer)]
+        patch_providers = {}
+        for r_idx in range(self.resolution_layer):
+            for p_idx in range(self.resolution_layer-1-r_idx, self.resolution_layer):
+                patch_size = self.patch_size_list[p_idx]
+                patch_providers[(r_idx, p_idx)] = self._train_patch_provider(
+                    input_pyramid[r_idx], patch_size, self.patch_spacing_list[p_idx], {'layer': r_idx, 'patch_size': patch_size})
+        return {
+            'input_pyramid': input_pyramid,
+            'patch_providers': patch_providers,
+        }
+
+    def synthesis(self):
+        self._check_settings()
+        self.history = []
+        return self._synthesis(self._prepare_input(), self._output_shape(self.output_size), history=self.history, checkpoint=self.checkpoint)
+
+    def synthesis_tiled(self, tile_size, tile_overlap, n_jobs=1, out=None):
+        """Synthesize the texture tile by tile
+
+        Tiles are optimized in overlapping windows. The part of a tile that
+        overlaps the tiles above and to the left is already synthesized and
+        stays fixed while the tile is optimized, so seams are consistent.
+        Buffers are sized by the tile, not by the output; with a memory-mapped
+        out the peak memory does not depend on output_size.
+        Tiles that do not overlap are processed in parallel. Each tile draws
+        its random choices from its own generator, seeded from the global
+        np.random state and the tile index, so the result does not depend
+        on n_jobs.
+
+        Args:
+            tile_size (int, int): Tile size (height, width)
+            tile_overlap (int, int): Overlap between neighboring tiles (height, width), at most half the tile size
+            n_jobs (int, optional): Number of worker threads. Defaults to 1.
+            out (ndarray, optional): uint8 array with the output shape to write into (e.g. np.memmap)
+
+        Returns:
+            ndarray: Synthesized texture
+        """
+        self._check_settings()
+        t_h, t_w = tile_size
+        o_h, o_w = tile_overlap
+        if not (0 < 2*o_h <= t_h and 0 < 2*o_w <= t_w):
+            raise ValueError('Tile overlap must be positive and at most half the tile size')
+        output_shape = self._output_shape(self.output_size)
+        if out is None:
+            out = np.zeros(output_shape, dtype=np.uint8)
+        elif out.shape != output_shape:
+            raise ValueError('A shape of out must be same with the output size')
+        tile_shape = self._output_shape(tile_size)
+        prepared = self._prepare_input()
+        self.history = []
+
+        entropy = np.random.randint(2**31)
+        step_h, step_w = t_h - o_h, t_w - o_w
+        n_h = max(1, -(-(output_shape[0] - o_h) // step_h))
+        n_w = max(1, -(-(output_shape[1] - o_w) // step_w))
+
+        def synthesis_tile(tile_idx):
+            i, j = tile_idx
+            y0, x0 = i*step_h, j*step_w
+            view = out[y0:y0+t_h, x0:x0+t_w]
+            v_h, v_w = view.shape[:2]
+            known_mask = np.zeros(tile_shape, dtype=bool)
+            if i > 0:
+                known_mask[:o_h, :v_w] = True
+            if j > 0:
+                known_mask[:v_h, :o_w] = True
+            known_image = np.zeros(tile_shape, dtype=self.dtype)
+            known_image[:v_h, :v_w] = view
+            tile_history = []
+            rng = np.random.default_rng([entropy, i, j])
+            tile = self._synthesis(prepared, tile_shape, known_image, known_mask, tile_history, rng=rng)
+            view[:] = tile[:v_h, :v_w]
+            return tile_history
+
+        # tile (i, j) overlaps tiles (i-1, j-1), (i-1, j), (i-1, j+1) and (i, j-1),
+        # so tiles on the same wave 2i+j do not overlap
+        waves = [[] for _ in range(2*(n_h-1) + n_w)]
+        for i in range(n_h):
+            for j in range(n_w):
+                waves[2*i+j].append((i, j))
+        tile_histories = {}
+        with ThreadPoolExecutor(n_jobs) as executor:
+            for wave in waves:
+                tile_histories.update(zip(wave, executor.map(synthesis_tile, wave)))
+        # in tile order, whatever the scheduling
+        for tile_idx in sorted(tile_histories):
+            self.history.extend(dict(record, tile=tile_idx) for record in tile_histories[tile_idx])
+        return out
+
+    def _synthesis(self, prepared, output_shape, known_image=None, known_mask=None, history=None, checkpoint=None, rng=None):
+        """Synthesize a texture
+
+        Args:
+            prepared (dict): Result of _prepare_input
+            output_shape (tuple): Shape of the texture
+            known_image (ndarray, optional): Pixels kept fixed during the synthesis
+            known_mask (ndarray, optional): Mask of the fixed pixels
+            history (list, optional): Energy and image change of each iteration are appended
+            checkpoint (Checkpoint, optional): Saves each stage, and resumes the run when self.resume is set
+            rng (np.random.Generator, optional): Generator of the random choices. Defaults to the global generators.
+
+        Returns:
+            ndarray: Synthesized texture
+        """
+        metrics = self.metrics
+        input_pyramid = prepared['input_pyramid']
+        if history is None:
+            history = []
+        with metrics.timer('pyramid', image='output'):
+            output_pyramid = get_pyramid(np.zeros(output_shape, dtype=self.dtype), self.resolution_layer)
+            if known_mask is not None:
+                known_pyramid, known_mask_pyramid = _get_known_pyramid(known_image, known_mask, self.resolution_layer)
+
+        def keep_known(texture, r_idx):
+            if known_mask is not None:
+                texture[known_mask_pyramid[r_idx]] = known_pyramid[r_idx][known_mask_pyramid[r_idx]]
+            return texture
+
+        # initialze
+        output_texture = output_pyramid[0]
+        input_patches_for_init = PatchGrid(input_pyramid[0], self.patch_size_list[-1], self.patch_spacing_list[-1])
+        rp = create_provider('RandomPick')
         rp.train(input_patches_for_init)
+        if rng is not None:
+            rp = rp.seeded(rng)
         output_texture = self.patch_aggregator(
             output_texture,
             rp,
             self.patch_size_list[-1],
             self.patch_spacing_list[-1]
         )
+        output_texture = keep_known(output_texture, 0)
+
+        resumed = None
+        if checkpoint is not None:
+            key = self._checkpoint_key()
+            resumed = checkpoint.load(key) if self.resume else None
+            if resumed is None:
+                checkpoint.clear()
+            else:
+                output_texture = resumed['image']
+                history.extend(resumed['history'])
 
         # synthesis
+        match_cache = self.match_cache_builder() if self.match_cache_builder else None
+        previous_provider, previous_layer = None, 0
+        if resumed is not None:
+            # the next stage warm-starts from the search state of the resumed one
+            previous_layer = resumed['stage'][0]
+            previous_provider = prepared['patch_providers'][resumed['stage']].warm_started(None)
+            previous_provider.set_search_state(resumed['provider_state'])
         for r_idx in range(self.resolution_layer):
-            resized_input_image = input_pyramid[r_idx]
-            for patch_size, patch_spacing in zip(self.patch_size_list[-1-r_idx:], self.patch_spacing_list[-1-r_idx:]):
-                input_patches = extract_patches(resized_input_image, patch_size, patch_spacing)
-                patch_provider = self.patch_provider_builder()
-                patch_provider.train(input_patches)
-                print(f'Layer: {output_texture.shape}, Patch: {patch_size}')
-                for i in tqdm(range(self.iteration_n)):
-                    output_texture = self.patch_aggregator(output_texture, patch_provider, patch_size, patch_spacing)
+            # the resumed texture is already at the resolution of its layer
+            if resumed is not None and r_idx < resumed['stage'][0]:
+                continue
+            for p_idx in range(self.resolution_layer-1-r_idx, self.resolution_layer):
+                if resumed is not None and (r_idx, p_idx) <= resumed['stage']:
+                    continue
+                patch_size, patch_spacing = self.patch_size_list[p_idx], self.patch_spacing_list[p_idx]
+                patch_provider = prepared['patch_providers'][(r_idx, p_idx)].warm_started(previous_provider, 2**(r_idx-previous_layer))
+                if rng is not None:
+                    patch_provider = patch_provider.seeded(rng)
+                previous_provider, previous_layer = patch_provider, r_idx
+                early_stopping = self.early_stopping_builder() if self.early_stopping_builder else None
+                labels = {'layer': r_idx, 'patch_size': patch_size}
+                for itr in self._progress(range(self._iteration_budget(r_idx)), f'Layer: {output_texture.shape}, Patch: {patch_size}'):
+                    stats = {}
+                    mask = self.sampling.mask(output_texture, patch_size, patch_spacing) if self.sampling is not None else None
+                    start = time.perf_counter()
+                    output_texture = self.patch_aggregator(output_texture, patch_provider, patch_size, patch_spacing, stats=stats, match_cache=match_cache, mask=mask)
+                    record_aggregation(metrics, time.perf_counter() - start, stats, labels)
+                    output_texture = keep_known(output_texture, r_idx)
+                    history.append({
+                        'layer': r_idx, 'patch_size': patch_size, 'iteration': itr,
+                        'energy': stats['energy'], 'queried': stats['queried'], 'change': stats['change'],
+                    })
+                    if early_stopping and early_stopping.update(stats['energy'], stats['change']):
+                        break
+                if checkpoint is not None:
+                    checkpoint.save(key, (r_idx, p_idx), output_texture, history, patch_provider.get_search_state())
 
             if r_idx < self.resolution_layer-1:
-                output_texture = cv2.pyrUp(output_texture.astype(np.uint8)).astype(np.float64)
+                output_texture = cv2.pyrUp(output_texture.astype(np.uint8)).astype(self.dtype)
+                # adjust size
+                next_h, next_w = output_pyramid[r_idx+1].shape[:2]
+                output_texture = output_texture[:next_h, :next_w]
+                output_texture = keep_known(output_texture, r_idx+1)
 
         return output_texture.astype(np.uint8)
+
+
+def _get_known_pyramid(known_image, known_mask, size):
+    """Gaussian pyramid of partially known pixels
+
+    A pixel of a coarse layer is known only when all of its footprint is known.
+
+    Returns:
+        (list of ndarray, list of ndarray): Pyramid of the pixels and of the mask (ascending order)
+    """
+    weight = known_mask.astype(known_image.dtype)
+    image_pyramid = get_pyramid(known_image * weight, size)
+    weight_pyramid = get_pyramid(weight, size)
+    known_pyramid = []
+    known_mask_pyramid = []
+    for image, weight in zip(image_pyramid, weight_pyramid):
+        mask = weight > 0.999
+        known_pyramid.append(np.where(mask, image / np.maximum(weight, 0.999), 0))
+        known_mask_pyramid.append(mask)
+    return known_pyramid, known_mask_pyramid
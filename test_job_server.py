@@ -0,0 +1,161 @@
+import asyncio
+import base64
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import cv2
+import numpy as np
+from src.job_server import JobServer
+
+STYLE_IMAGE = './test_images/style_transfer/style/van_gogh_starry.jpg'
+CONTENT_IMAGE = './test_images/style_transfer/content/city_river.jpg'
+TEXTURE_IMAGE = './test_images/texture_synthesis/input_sample/wara.jpg'
+
+
+def encode_image(filename, size):
+    image = cv2.resize(cv2.imread(filename), (size, size), interpolation=cv2.INTER_AREA)
+    return base64.b64encode(cv2.imencode('.png', image)[1].tobytes()).decode()
+
+
+def start_server():
+    """Run a job server with a single worker in a background thread
+
+    Returns:
+        str: Base URL of the server
+    """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = JobServer(n_workers=1)
+    threading.Thread(target=asyncio.run, args=(server.serve('127.0.0.1', port),), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return f'http://127.0.0.1:{port}'
+
+
+def request(url, method='GET', job=None):
+    """Send a request like a client would
+
+    Returns:
+        (int, bytes): Status and body
+    """
+    data = None if job is None else json.dumps(job).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data, method=method)) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def synthesis_job(size, iteration_n):
+    return {
+        'kind': 'synthesis',
+        'images': {'input': encode_image(TEXTURE_IMAGE, size)},
+        'params': {
+            'output_size': [size * 2, size * 2], 'resolution_layer': 2, 'patch_size_list': [[16, 16], [8, 8]],
+            'patch_spacing_list': [[4, 4], [2, 2]], 'iteration_n': iteration_n,
+        },
+        'search': {'name': 'NN'},
+        'aggregate': {'name': 'l2'},
+    }
+
+
+def transfer_job():
+    return {
+        'kind': 'transfer',
+        'images': {'content': encode_image(CONTENT_IMAGE, 64), 'style': encode_image(STYLE_IMAGE, 64)},
+        'params': {
+            'resolution_layer': 2, 'patch_size_list': [[16, 16], [8, 8]],
+            'patch_spacing_list': [[4, 4], [2, 2]], 'iteration_n': 2,
+        },
+        'search': {'name': 'NN'},
+        'aggregate': {'name': 'l2'},
+    }
+
+
+def wait(url, job_id, statuses):
+    for _ in range(1200):
+        status, body = request(f'{url}/jobs/{job_id}')
+        assert status == 200, body
+        info = json.loads(body)
+        if info['status'] in statuses:
+            return info
+        time.sleep(0.1)
+    raise AssertionError(f'Job {job_id} is still {info["status"]}')
+
+
+def check_submit_and_poll(url):
+    """A submitted transfer job runs to a PNG result
+    """
+    status, body = request(f'{url}/jobs', 'POST', transfer_job())
+    assert status == 202, body
+    job_id = json.loads(body)['id']
+    info = wait(url, job_id, ('done', 'failed'))
+    assert info['status'] == 'done', info
+    status, body = request(f'{url}/jobs/{job_id}/result')
+    assert status == 200
+    result = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+    assert result.shape == (64, 64, 3), result.shape
+
+
+def check_malformed_jobs(url):
+    """Malformed jobs are answered with 400 and never queued
+    """
+    no_content = transfer_job()
+    del no_content['images']['content']
+    empty_image, bad_base64, not_an_image = transfer_job(), transfer_job(), transfer_job()
+    empty_image['images']['style'] = ''
+    bad_base64['images']['style'] = '!!!'
+    not_an_image['images']['style'] = base64.b64encode(b'not an image').decode()
+    unknown_search = dict(transfer_job(), search={'name': 'Unknown'})
+    for job in ([], 'job', {'kind': 'video'}, no_content, empty_image, bad_base64, not_an_image, unknown_search):
+        status, body = request(f'{url}/jobs', 'POST', job)
+        assert status == 400, (status, body)
+    status, body = request(f'{url}/stats')
+    assert json.loads(body)['queue_depth'] == 0, body
+
+
+def check_cancel(url):
+    """Queued jobs can be cancelled, running and finished ones can not
+    """
+    status, body = request(f'{url}/jobs', 'POST', synthesis_job(64, 20))
+    running_id = json.loads(body)['id']
+    wait(url, running_id, ('running', 'done'))
+    status, body = request(f'{url}/jobs', 'POST', synthesis_job(32, 1))
+    queued_id = json.loads(body)['id']
+
+    status, body = request(f'{url}/jobs/{queued_id}', 'DELETE')
+    assert status == 200, body
+    assert json.loads(body)['status'] == 'cancelled', body
+    status, body = request(f'{url}/jobs/{queued_id}', 'DELETE')
+    assert status == 409, body
+    status, body = request(f'{url}/jobs/{running_id}', 'DELETE')
+    assert status == 409, body
+    status, body = request(f'{url}/jobs/unknown', 'DELETE')
+    assert status == 404, body
+
+    wait(url, running_id, ('done',))
+    # the worker skips the cancelled job
+    assert json.loads(request(f'{url}/jobs/{queued_id}')[1])['status'] == 'cancelled'
+    status, body = request(f'{url}/stats')
+    stats = json.loads(body)
+    assert stats['cancelled'] == 1 and stats['queue_depth'] == 0, stats
+
+
+def main():
+    url = start_server()
+    check_submit_and_poll(url)
+    check_malformed_jobs(url)
+    check_cancel(url)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import random
+import cv2
+import numpy as np
+from src.common.patch_aggregation import AdaptiveSampling, MatchCache, PatchGrid
+from src.common.patch_aggregation.patch_aggregate import _get_match_patches
+from src.common.patch_aggregation.patch_provider import ParallelPatchProvider, PatchMatch
+from src.style_transfer import StyleTransfer
+from src.texture_synthesis import TextureSynthesis
+
+STYLE_IMAGE = './test_images/style_transfer/style/van_gogh_starry.jpg'
+CONTENT_IMAGE = './test_images/style_transfer/content/city_river.jpg'
+TEXTURE_IMAGE = './test_images/texture_synthesis/input_sample/wara.jpg'
+
+
+def load_image(filename, size):
+    return cv2.resize(cv2.imread(filename), (size, size), interpolation=cv2.INTER_AREA)
+
+
+def seed_all(seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def check_grid_layout_forwarded():
+    """A wrapped PatchMatch keeps its field on the grid through a match cache
+    """
+    exemplar = load_image(STYLE_IMAGE, 128).astype(np.float64)
+    target = load_image(CONTENT_IMAGE, 128).astype(np.float64)
+    patch_match = PatchMatch()
+    patch_match.train(PatchGrid(exemplar, (8, 8), (2, 2)))
+    patch_provider = ParallelPatchProvider(patch_match, 4)
+    assert patch_provider.uses_grid_layout
+
+    match_cache = MatchCache(0.5)
+    target_grid = PatchGrid(target, (8, 8), (2, 2))
+    for noise in (0, 1, 2):
+        match_cache.get_patches_on_grid(patch_provider, PatchGrid(target + noise, (8, 8), (2, 2)))
+        assert patch_match._cells.shape == target_grid.grid_shape + (2,), patch_match._cells.shape
+
+
+def check_masked_grid_layout():
+    """Adaptive sampling queries a wrapped PatchMatch with the whole grid
+    """
+    exemplar = load_image(STYLE_IMAGE, 128).astype(np.float64)
+    target = load_image(CONTENT_IMAGE, 128).astype(np.float64)
+    patch_match = PatchMatch()
+    patch_match.train(PatchGrid(exemplar, (8, 8), (2, 2)))
+    patch_provider = ParallelPatchProvider(patch_match, 4)
+
+    target_grid = PatchGrid(target, (8, 8), (2, 2))
+    mask = AdaptiveSampling(std_threshold=16).mask(target, (8, 8), (2, 2))
+    assert not mask.all()
+    for match_cache in (None, MatchCache(0.5)):
+        stats = {}
+        _get_match_patches(patch_provider, target_grid, match_cache, stats, mask)
+        assert patch_match._cells.shape == target_grid.grid_shape + (2,), patch_match._cells.shape
+        assert stats['queried'] == len(target_grid)
+
+
+def transfer(n_jobs, sampling=False):
+    seed_all()
+    style_transfer = StyleTransfer(
+        style_image=load_image(STYLE_IMAGE, 96),
+        content_image=load_image(CONTENT_IMAGE, 96),
+        resolution_layer=2,
+        patch_size_list=((16, 16), (8, 8)),
+        patch_spacing_list=((4, 4), (2, 2)),
+        iteration_n=3,
+    ).search_by_PatchMatch(
+    ).aggregate_by_l2(
+    ).requery_changed_only(
+        0.5
+    ).search_in_parallel(
+        n_jobs
+    ).show_progress(
+        False
+    )
+    if sampling:
+        style_transfer.sample_adaptively(std_threshold=16)
+    return style_transfer.transfer()
+
+
+def check_parallel_patch_match_transfer():
+    """Wrapping PatchMatch does not change the result of a run
+    """
+    assert np.array_equal(transfer(4), transfer(1))
+    assert np.array_equal(transfer(4, sampling=True), transfer(1, sampling=True))
+
+
+def synthesis_tiled(n_jobs):
+    seed_all()
+    return TextureSynthesis(
+        input_image=load_image(TEXTURE_IMAGE, 48),
+        output_size=(112, 112),
+        resolution_layer=2,
+        patch_size_list=((16, 16), (8, 8)),
+        patch_spacing_list=((4, 4), (2, 2)),
+        iteration_n=2,
+    ).search_by_PatchMatch(
+    ).aggregate_by_l2(
+    ).show_progress(
+        False
+    ).synthesis_tiled((48, 48), (16, 16), n_jobs=n_jobs)
+
+
+def check_tiled_reproducible():
+    """Tiled synthesis does not depend on the number of worker threads
+    """
+    assert np.array_equal(synthesis_tiled(4), synthesis_tiled(1))
+
+
+def main():
+    check_grid_layout_forwarded()
+    check_masked_grid_layout()
+    check_parallel_patch_match_transfer()
+    check_tiled_reproducible()
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
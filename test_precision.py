@@ -0,0 +1,113 @@
+import random
+import cv2
+import numpy as np
+from src.common.patch_aggregation import PatchGrid, l2_norm_aggregate, lp_norm_irls_aggregate
+from src.common.patch_aggregation.patch_provider import NN
+from src.common.patch_aggregation.patch_provider.patch_provider import PatchProvider
+from src.style_transfer import StyleTransfer
+from src.texture_synthesis import TextureSynthesis
+
+STYLE_IMAGE = './test_images/style_transfer/style/van_gogh_starry.jpg'
+CONTENT_IMAGE = './test_images/style_transfer/content/city_river.jpg'
+TEXTURE_IMAGE = './test_images/texture_synthesis/input_sample/wara.jpg'
+
+# tolerances against the float64 path stated in README.md
+AGGREGATE_TOL = 1e-4
+ENERGY_TOL = 1e-3
+# the histogram matching of each iteration floors to integer levels, so the runs diverge
+STYLE_ENERGY_TOL = 5e-2
+
+
+class FixedMatch(PatchProvider):
+    """Returns the same matches whatever the query, in the dtype of the query
+    """
+
+    def __init__(self, match):
+        self.match = match
+
+    def train(self, input_patches):
+        pass
+
+    def get_patch(self, ref_patch):
+        raise NotImplementedError
+
+    def get_patches(self, ref_patches):
+        return self.match.astype(ref_patches.dtype)
+
+
+def load_image(filename, size):
+    return cv2.resize(cv2.imread(filename), (size, size), interpolation=cv2.INTER_AREA)
+
+
+def seed_all(seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def check_aggregators():
+    """float32 and float64 aggregators agree on identical matches
+    """
+    exemplar = load_image(STYLE_IMAGE, 128).astype(np.float64)
+    target = load_image(CONTENT_IMAGE, 128).astype(np.float64)
+    for patch_size, patch_spacing in (((16, 16), (4, 4)), ((8, 8), (2, 2))):
+        nn = NN()
+        nn.train(PatchGrid(exemplar, patch_size, patch_spacing))
+        patch_provider = FixedMatch(nn.get_patches_on_grid(PatchGrid(target, patch_size, patch_spacing)))
+        aggregators = {
+            'l2': l2_norm_aggregate,
+            'lp_irls': lambda *args: lp_norm_irls_aggregate(*args, irls_iteration=10, p_norm=1.2),
+        }
+        for name, aggregate in aggregators.items():
+            output64 = aggregate(target, patch_provider, patch_size, patch_spacing)
+            output32 = aggregate(target.astype(np.float32), patch_provider, patch_size, patch_spacing)
+            assert output32.dtype == np.float32
+            error = np.abs(output32.astype(np.float64) - output64).max()
+            print(f'{name} {patch_size}/{patch_spacing}: max abs error {error:.2e}')
+            assert error < AGGREGATE_TOL, (name, patch_size, error)
+
+
+def final_energy(pipeline, run, seed):
+    seed_all(seed)
+    run(pipeline.search_by_NN().aggregate_by_lp_irls(irls_iteration=10, p_norm=1.2).show_progress(False))
+    return pipeline.history[-1]['energy']
+
+
+def check_end_to_end():
+    """float32 runs end within the energy tolerance of float64 runs
+    """
+    for dtype_run, tol in (
+        (lambda dtype: (StyleTransfer(
+            content_image=load_image(CONTENT_IMAGE, 96),
+            style_image=load_image(STYLE_IMAGE, 96),
+            resolution_layer=2,
+            patch_size_list=((16, 16), (8, 8)),
+            patch_spacing_list=((8, 8), (4, 4)),
+            iteration_n=3,
+            dtype=dtype,
+        ), StyleTransfer.transfer), STYLE_ENERGY_TOL),
+        (lambda dtype: (TextureSynthesis(
+            input_image=load_image(TEXTURE_IMAGE, 64),
+            output_size=(96, 96),
+            resolution_layer=2,
+            patch_size_list=((16, 16), (8, 8)),
+            patch_spacing_list=((4, 4), (2, 2)),
+            iteration_n=3,
+            dtype=dtype,
+        ), TextureSynthesis.synthesis), ENERGY_TOL),
+    ):
+        for seed in range(4):
+            energy64 = final_energy(*dtype_run(np.float64), seed)
+            energy32 = final_energy(*dtype_run(np.float32), seed)
+            gap = abs(energy32 - energy64) / energy64
+            print(f'energy float64 {energy64:.4f} float32 {energy32:.4f}: relative gap {gap:.2e}')
+            assert gap < tol, gap
+
+
+def main():
+    check_aggregators()
+    check_end_to_end()
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()